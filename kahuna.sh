@@ -4,6 +4,8 @@
 
 # Exit code to be used when opening an interactive shell
 EXIT_OPEN_SHELL=10
+# Exit code returned by the client when there is no daemon running
+EXIT_NO_DAEMON=11
 
 # Allow creating symlinks in the path to point to this
 # script
@@ -13,20 +15,34 @@ else
     BASEDIR=`dirname $0`
 fi
 
-# Enter the real directori before performing any operation
+# Enter the real directori before performing any operation, keeping
+# the original one to resolve relative paths
+export KAHUNA_CWD=`pwd`
 cd $BASEDIR
 export JYTHONPATH=$BASEDIR
 
-# Ensure the classpath file exist
-CPFILE=kahuna/abiquo-jars.pth
-! [ -f $CPFILE ] && mvn clean compile -U
+# If a daemon is running, send it the command to avoid booting the JVM
+RET=$EXIT_NO_DAEMON
+if [ -f $HOME/.kahuna/daemon ] && which python >/dev/null 2>&1; then
+    python kahuna/client.py "$@"
+    RET=$?
+fi
+
+if [ $RET -eq $EXIT_NO_DAEMON ]; then
+    # Ensure the classpath file exist
+    CPFILE=kahuna/abiquo-jars.pth
+    ! [ -f $CPFILE ] && mvn clean compile -U
 
-# Export the classpath and run the command line script
-export CLASSPATH=`cat $CPFILE`
-${KAHUNA_HOME}/bin/jython kahuna/cli.py $*
+    # Export the classpath and run the command line script
+    export CLASSPATH=`cat $CPFILE`
+    ${KAHUNA_HOME}/bin/jython kahuna/cli.py $*
+    RET=$?
+fi
 
 # Tricky: If the CLI returns this code, open an interactive shell 
-if [ $? -eq $EXIT_OPEN_SHELL ]; then
+if [ $RET -eq $EXIT_OPEN_SHELL ]; then
     ${KAHUNA_HOME}/bin/jython
 fi
 
+exit $RET
+
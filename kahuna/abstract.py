@@ -1,7 +1,8 @@
 #!/usr/bin/env jython
 
 import logging
-from kahuna.session import ContextLoader
+from kahuna.inventory import flush_inventories
+from kahuna.session import ContextPool
 
 log = logging.getLogger('kahuna')
 
@@ -35,14 +36,17 @@ class AbsPlugin:
         it has the context loaded.
         """
         log.debug("Loading context for plugin execution")
-        self._context = ContextLoader(self._config_overrides()).load()
+        self._context = ContextPool().borrow(self._config_overrides())
 
     def _close_context(self):
-        """ Closes the context after plugin execution.
+        """ Releases the context after plugin execution.
 
-        It should be called only from the plugin manager.
+        The context is given back to the pool, so following commands
+        can reuse it. It should be called only from the plugin manager.
         """
+        # Entities remembered by the command are written just once
+        flush_inventories()
         if self._context:
-            log.debug("Context closed after plugin execution")
-            self._context.close()
+            log.debug("Context released after plugin execution")
+            ContextPool().release(self._context)
             self._context = None
@@ -0,0 +1,72 @@
+#!/usr/bin/env python
+
+# Thin client for the Kahuna daemon. It does not depend on Jython nor on
+# the jclouds libraries, so it can be run with any Python interpreter to
+# avoid the JVM startup time.
+
+import os
+import socket
+import sys
+
+# Exit code used when there is no daemon to send the command to
+EXIT_NO_DAEMON = 11
+
+DAEMON_FILE = os.environ['HOME'] + "/.kahuna/daemon"
+TERMINATOR = "\0".encode("ascii")
+
+
+def daemon_address():
+    """ Reads the port and token published by the running daemon """
+    try:
+        f = open(DAEMON_FILE, "r")
+        try:
+            port, token = f.read().split()
+        finally:
+            f.close()
+    except (IOError, ValueError):
+        return None
+    return (int(port), token)
+
+
+def send(args):
+    """ Sends the command to the daemon and streams back its output """
+    address = daemon_address()
+    if not address:
+        return EXIT_NO_DAEMON
+    port, token = address
+    try:
+        sock = socket.create_connection(("127.0.0.1", port))
+    except socket.error:
+        return EXIT_NO_DAEMON
+
+    out = getattr(sys.stdout, "buffer", sys.stdout)
+    try:
+        cwd = os.environ.get("KAHUNA_CWD", os.getcwd())
+        request = "%s\n%s\n%s\n" % (token, cwd, "\t".join(args))
+        sock.sendall(request.encode("utf-8"))
+        received = "".encode("ascii")
+        while True:
+            data = sock.recv(4096)
+            if not data:
+                break
+            received += data
+            # Print everything but the trailing exit code
+            pos = received.find(TERMINATOR)
+            if pos < 0:
+                out.write(received)
+                out.flush()
+                received = "".encode("ascii")
+        pos = received.find(TERMINATOR)
+        if pos < 0:
+            # The daemon closed the connection without an exit code
+            out.write(received)
+            return 1
+        out.write(received[:pos])
+        out.flush()
+        return int(received[pos + 1:].strip() or 0)
+    finally:
+        sock.close()
+
+
+if __name__ == "__main__":
+    sys.exit(send(sys.argv[1:]))
@@ -71,6 +71,23 @@ class Config:
             # Ignore errors if no logging level has been defined
             pass
 
+        # Context pool
+        self.pool_idle_timeout = 300
+        self.pool_check_interval = 60
+        if config.has_option("pool", "idle-timeout"):
+            self.pool_idle_timeout = config.getint("pool", "idle-timeout")
+        if config.has_option("pool", "check-interval"):
+            self.pool_check_interval = config.getint("pool", "check-interval")
+
+        # Inventory
+        self.inventory_ttl = 600
+        if config.has_option("inventory", "ttl"):
+            self.inventory_ttl = config.getint("inventory", "ttl")
+        self.inventory_rebuild_interval = 30
+        if config.has_option("inventory", "rebuild-interval"):
+            self.inventory_rebuild_interval = config.getint("inventory",
+                    "rebuild-interval")
+
         # Client
         self.client_config = []
         if config.has_section("client"):
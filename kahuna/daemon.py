@@ -0,0 +1,159 @@
+#!/usr/bin/env jython
+
+import logging
+import os
+import socket
+import sys
+import time
+import SocketServer
+from java.lang import Throwable
+from java.util import UUID
+from kahuna import FORMAT
+from kahuna.pluginmanager import PluginManager
+from kahuna.session import ContextPool
+from kahuna.sync import keep_snapshots
+
+log = logging.getLogger('kahuna')
+
+# File where the running daemon publishes its port and access token
+DAEMON_FILE = os.environ['HOME'] + "/.kahuna/daemon"
+
+# The daemon instance running in this process, if any
+current = None
+
+
+class KahunaDaemon(SocketServer.TCPServer):
+    """ Long lived process that runs kahuna commands.
+
+    It keeps the plugins loaded and the contexts open between commands,
+    so each command does not have to pay the JVM and context startup
+    time. Commands are read from a local socket and run one at a time.
+    """
+    allow_reuse_address = True
+
+    def __init__(self, port=0):
+        """ Binds the daemon to the given local port """
+        SocketServer.TCPServer.__init__(self, ("127.0.0.1", port),
+                _CommandHandler)
+        self.token = UUID.randomUUID().toString()
+        self.started = time.time()
+        self.served = 0
+        self.__pluginmanager = PluginManager()
+        self.__running = False
+
+    def serve(self):
+        """ Publishes the daemon and serves commands until stopped """
+        global current
+        port = self.server_address[1]
+        self._publish(port)
+        current = self
+        self.__running = True
+        keep_snapshots()
+        log.info("Kahuna daemon listening on port %s" % port)
+        # Wake up periodically to close the contexts that are not used
+        self.socket.settimeout(60)
+        try:
+            while self.__running:
+                self.handle_request()
+                ContextPool().evict_idle()
+        finally:
+            current = None
+            self.server_close()
+            ContextPool().close()
+            if os.path.exists(DAEMON_FILE):
+                os.remove(DAEMON_FILE)
+            log.info("Kahuna daemon stopped")
+
+    def get_request(self):
+        """ Accepts a connection without the listening socket timeout """
+        request, address = self.socket.accept()
+        request.settimeout(None)
+        return (request, address)
+
+    def stop(self):
+        """ Stops the daemon once the current command finishes """
+        self.__running = False
+
+    def status(self):
+        """ Returns a list of (name, value) tuples with the daemon status """
+        return [("pid", os.getpid()),
+                ("port", self.server_address[1]),
+                ("uptime", "%d s" % (time.time() - self.started)),
+                ("commands served", self.served),
+                ("open contexts", ContextPool().size())]
+
+    def dispatch(self, args, out):
+        """ Runs the given command line writing its output to out """
+        handler = logging.StreamHandler(out)
+        handler.setFormatter(logging.Formatter(FORMAT))
+        stdout = sys.stdout
+        stderr = sys.stderr
+        # optparse writes the usage and its errors to stderr
+        sys.stdout = out
+        sys.stderr = out
+        log.addHandler(handler)
+        try:
+            try:
+                if len(args) < 1:
+                    print "Usage: kahuna <plugin> <command> [<options>]"
+                    print "The following plugins are available:\n"
+                    self.__pluginmanager.help_all()
+                elif len(args) == 1:
+                    print "Usage: kahuna <plugin> <command> [<options>]"
+                    return self.__pluginmanager.call(args[0], None, None)
+                else:
+                    return self.__pluginmanager.call(args[0], args[1],
+                            args[2:])
+            except SystemExit, ex:
+                # optparse exits on --help and on invalid options
+                return exit_code(ex)
+            except (Exception, Throwable), ex:
+                log.exception("Error running: %s" % " ".join(args))
+                print "Error: %s" % ex
+                return 1
+        finally:
+            log.removeHandler(handler)
+            sys.stdout = stdout
+            sys.stderr = stderr
+            self.served += 1
+
+    def _publish(self, port):
+        """ Writes the daemon port and token so clients can connect """
+        fd = os.open(DAEMON_FILE, os.O_WRONLY | os.O_CREAT | os.O_TRUNC,
+                0600)
+        try:
+            os.write(fd, "%s %s\n" % (port, self.token))
+        finally:
+            os.close(fd)
+
+
+def exit_code(ex):
+    """ Returns the exit code of a SystemExit, printing its message """
+    if ex.code is None or isinstance(ex.code, int):
+        return ex.code
+    print ex.code
+    return 1
+
+
+class _CommandHandler(SocketServer.StreamRequestHandler):
+    """ Reads a command from a client and streams back its output.
+
+    The client sends the access token, its working directory and the tab
+    separated command line, each one in its own line. The output of the
+    command is written as it is produced, followed by a NUL character and
+    the exit code.
+    """
+    def handle(self):
+        token = self.rfile.readline().strip()
+        if token != self.server.token:
+            log.warn("Rejected connection with an invalid token")
+            return
+        os.environ["KAHUNA_CWD"] = self.rfile.readline().rstrip("\n")
+        line = self.rfile.readline().rstrip("\n")
+        args = line.split("\t") if line else []
+        log.debug("Running: %s" % " ".join(args))
+        try:
+            ret = self.server.dispatch(args, self.wfile)
+            self.wfile.write("\0%s\n" % (ret or 0))
+        except socket.error, ex:
+            log.warn("Client disconnected: %s" % ex)
@@ -0,0 +1,474 @@
+#!/usr/bin/env jython
+
+import hashlib
+import logging
+import os
+import pickle
+import threading
+import time
+from config import Config
+from com.abiquo.model.enumerator import ConversionState
+from com.abiquo.model.enumerator import HypervisorType
+from java.lang import Throwable
+
+log = logging.getLogger('kahuna')
+
+# Increase it when the format of the cached inventory changes
+INVENTORY_VERSION = 3
+
+# The kinds of entities in each group, used to refresh them together
+GROUPS = {
+    "cloud": ["vdc", "vapp", "vm", "volume"],
+    "infrastructure": ["machine"],
+    "templates": ["template"],
+}
+
+# The inventories of this process, by endpoint and user
+_inventories = {}
+_inventories_lock = threading.Lock()
+
+
+def inventory(context):
+    """ Returns the inventory for the endpoint and user of the context """
+    api_context = context.getApiContext()
+    key = "%s %s" % (api_context.getEndpoint(), api_context.getIdentity())
+    _inventories_lock.acquire()
+    try:
+        inv = _inventories.get(key)
+        if not inv:
+            inv = Inventory(key)
+            _inventories[key] = inv
+        inv._set_context(context)
+        return inv
+    finally:
+        _inventories_lock.release()
+
+
+class Inventory:
+    """ Local cache of the names and ids of the cloud entities.
+
+    Looking up an entity by name in the API requires listing all the
+    entities of its kind. The inventory keeps, for each kind of entity,
+    an index by name and by id with the ids needed to fetch the entity
+    directly, so lookups only need a few requests.
+
+    Indexes are stored in ~/.kahuna/inventory and rebuilt when they are
+    older than the configured TTL, when an entity is not found, or when
+    the cached entry is stale. Only the index of the missing kind is
+    rebuilt, and not more often than the configured rebuild interval, so
+    looking up names that do not exist does not crawl the API each time.
+    """
+
+    def __init__(self, key):
+        """ Initializes the inventory of the given endpoint and user """
+        self.__file = "%s/.kahuna/inventory/%s.cache" % (os.environ['HOME'],
+                hashlib.md5(key).hexdigest())
+        config = Config()
+        self.__ttl = config.inventory_ttl
+        self.__rebuild_interval = config.inventory_rebuild_interval
+        self.__context = None
+        self.__indexes = None
+        self.__dirty = False
+        self.__lock = threading.RLock()
+
+    def _set_context(self, context):
+        """ Sets the context used to fetch the entities """
+        self.__context = context
+
+    def find(self, kind, name):
+        """ Finds the entity of the given kind with the given name """
+        return self.__lookup(kind, "names", name)
+
+    def get(self, kind, id):
+        """ Gets the entity of the given kind with the given id """
+        return self.__lookup(kind, "ids", id)
+
+    def find_vms_by_template(self, template):
+        """ Finds the virtual machines whose template name contains the
+        given text """
+        refs = [ref for ref in self.__index("vm")["ids"].values()
+                if ref[3] and template in ref[3]]
+        vms = [self.__resolve("vm", ref) for ref in refs]
+        return [vm for vm in vms if vm]
+
+    def find_compatible_vdcs(self, template_id):
+        """ Yields the virtual datacenters where the given template can be
+        deployed.
+
+        The templates are indexed with the hypervisor types that can run
+        them, either directly or with a finished conversion, and the
+        virtual datacenters with their datacenter and hypervisor type, so
+        only the yielded virtual datacenters are fetched.
+        """
+        found = False
+        for rebuild in (False, True):
+            if rebuild:
+                if found or not self.__can_rebuild("vdc"):
+                    return
+                # New virtual datacenters or conversions may be missing
+                self.__build("vdc")
+                self.__build("template")
+            template = self.__index("template")["ids"].get(template_id)
+            if not template:
+                continue
+            refs = [ref for ref in self.__index("vdc")["ids"].values()
+                    if ref[1] == template[0] and ref[2] in template[2]]
+            for ref in refs:
+                vdc = self.__resolve("vdc", ref)
+                if vdc:
+                    found = True
+                    yield vdc
+
+    def remember(self, kind, name, id, ref):
+        """ Adds an entity created by kahuna to the inventory.
+
+        Changes are written to disk by flush, once the command finishes.
+        """
+        self.__lock.acquire()
+        try:
+            index = self.__index(kind, False)
+            if index is not None:
+                index["names"][name] = ref
+                index["ids"][id] = ref
+                self.__dirty = True
+        finally:
+            self.__lock.release()
+
+    def forget(self, kind, name=None, id=None):
+        """ Removes an entity deleted by kahuna from the inventory.
+
+        Changes are written to disk by flush, once the command finishes.
+        """
+        self.__lock.acquire()
+        try:
+            index = self.__index(kind, False)
+            if index is not None:
+                ref = index["names"].pop(name, None) or \
+                        index["ids"].get(id)
+                for key, value in index["ids"].items():
+                    if value == ref:
+                        del index["ids"][key]
+                for key, value in index["names"].items():
+                    if value == ref:
+                        del index["names"][key]
+                self.__dirty = True
+        finally:
+            self.__lock.release()
+
+    def flush(self):
+        """ Writes the remembered and forgotten entities to disk """
+        self.__lock.acquire()
+        try:
+            if self.__dirty:
+                self._save()
+        finally:
+            self.__lock.release()
+
+    def refresh(self, groups=None):
+        """ Rebuilds the given groups (all of them by default) """
+        built = []
+        for group in groups or GROUPS.keys():
+            for kind in GROUPS[group]:
+                # Some crawlers also index the parents of the entities
+                if kind not in built:
+                    built.extend(self.__build(kind))
+
+    def clear(self):
+        """ Removes all the cached entities """
+        self.__lock.acquire()
+        try:
+            self.__indexes = {}
+            self.__dirty = False
+            if os.path.exists(self.__file):
+                os.remove(self.__file)
+        finally:
+            self.__lock.release()
+
+    def status(self):
+        """ Returns a list of (kind, entities, age) tuples """
+        self.__load()
+        status = []
+        for group in sorted(GROUPS.keys()):
+            for kind in GROUPS[group]:
+                cached = self.__indexes.get(kind)
+                if cached:
+                    status.append((kind, len(cached["ids"]),
+                        "%d s" % (time.time() - cached["updated"])))
+                else:
+                    status.append((kind, 0, "-"))
+        return status
+
+    def __lookup(self, kind, index_name, key):
+        """ Looks up an entity, rebuilding the index if needed """
+        ref = self.__index(kind)[index_name].get(key)
+        if ref:
+            entity = self.__resolve(kind, ref)
+            if entity and self.__matches(kind, entity, index_name, key):
+                return entity
+            log.debug("Stale %s entry in the inventory: %s" % (kind, key))
+        if not self.__can_rebuild(kind):
+            # The index has been built recently, so the entity does not
+            # exist or has been removed outside kahuna
+            return None
+        # Not found or stale. Rebuild the index and try again
+        self.__build(kind)
+        ref = self.__index(kind)[index_name].get(key)
+        return self.__resolve(kind, ref) if ref else None
+
+    def __matches(self, kind, entity, index_name, key):
+        """ Checks that the fetched entity is the indexed one """
+        if index_name == "ids":
+            return entity.getId() == key
+        return _name(kind, entity) == key
+
+    def __resolve(self, kind, ref):
+        """ Fetches the entity identified by the given reference """
+        try:
+            return _RESOLVERS[kind](self.__context, ref)
+        except (Exception, Throwable), ex:
+            log.debug("Could not fetch %s %s: %s" % (kind, ref, ex))
+            return None
+
+    def __index(self, kind, build=True):
+        """ Returns the index of the given kind, building it if needed """
+        self.__lock.acquire()
+        try:
+            self.__load()
+            cached = self.__indexes.get(kind)
+            if not cached or time.time() - cached["updated"] > self.__ttl:
+                if not build:
+                    return None
+                self.__build(kind)
+                cached = self.__indexes[kind]
+            return cached
+        finally:
+            self.__lock.release()
+
+    def __can_rebuild(self, kind):
+        """ Checks if the index of the given kind is old enough to be
+        rebuilt after a miss """
+        self.__load()
+        cached = self.__indexes.get(kind)
+        return not cached or \
+                time.time() - cached["updated"] >= self.__rebuild_interval
+
+    def __build(self, kind):
+        """ Fetches all the entities of a kind from the API.
+
+        Returns the kinds that have been indexed, since the crawler of a
+        kind also indexes the parents it goes through.
+        """
+        crawl, kinds = _CRAWLERS[kind]
+        log.debug("Building the %s inventory..." % kind)
+        start = time.time()
+        built = {}
+        for covered in kinds:
+            built[covered] = {"updated": start, "names": {}, "ids": {}}
+        for covered, name, id, ref in crawl(self.__context):
+            built[covered]["names"].setdefault(name, ref)
+            built[covered]["ids"][id] = ref
+        log.debug("%s inventory built in %.2f seconds" % (kind,
+            time.time() - start))
+        self.__lock.acquire()
+        try:
+            self.__load()
+            self.__indexes.update(built)
+            self._save()
+        finally:
+            self.__lock.release()
+        return kinds
+
+    def __load(self):
+        """ Loads the cached inventory from disk """
+        if self.__indexes is not None:
+            return
+        self.__indexes = {}
+        if not os.path.exists(self.__file):
+            return
+        try:
+            f = open(self.__file, "rb")
+            try:
+                cached = pickle.load(f)
+            finally:
+                f.close()
+            if cached.get("version") == INVENTORY_VERSION:
+                self.__indexes = cached["indexes"]
+        except Exception, ex:
+            log.debug("Could not read the inventory: %s" % ex)
+
+    def _save(self):
+        """ Writes the inventory to disk """
+        try:
+            directory = os.path.dirname(self.__file)
+            if not os.path.isdir(directory):
+                os.makedirs(directory)
+            tmp = "%s.%s" % (self.__file, threading.currentThread().getName())
+            f = open(tmp, "wb")
+            try:
+                pickle.dump({"version": INVENTORY_VERSION,
+                    "indexes": self.__indexes}, f)
+            finally:
+                f.close()
+            os.rename(tmp, self.__file)
+            self.__dirty = False
+        except Exception, ex:
+            log.debug("Could not write the inventory: %s" % ex)
+
+
+def flush_inventories():
+    """ Writes the pending changes of all the inventories to disk """
+    _inventories_lock.acquire()
+    try:
+        inventories = _inventories.values()
+    finally:
+        _inventories_lock.release()
+    for inv in inventories:
+        inv.flush()
+
+
+def _name(kind, entity):
+    """ Returns the name used to index the given entity """
+    if kind == "vm":
+        return entity.getInternalName()
+    return entity.getName()
+
+
+def _template_datacenter(template):
+    """ Gets the id of the datacenter repository of the template """
+    # Templates are under: .../datacenterrepositories/<id>/...
+    segments = template.unwrap().getEditLink().getHref().split("/")
+    return int(segments[segments.index("datacenterrepositories") + 1])
+
+
+def _compatible_types(template):
+    """ Gets the names of the hypervisor types that can run the template """
+    formats = [template.getDiskFormatType()]
+    for conversion in template.listConversions():
+        if conversion.getState() == ConversionState.FINISHED:
+            formats.append(conversion.getTargetFormat())
+    return tuple([type.name() for type in HypervisorType.values()
+        if [format for format in formats if type.isCompatible(format)]])
+
+
+def _link_id(entity, rel):
+    """ Gets the id of the entity referenced by the given link """
+    link = entity.unwrap().searchLink(rel)
+    return int(link.getHref().rstrip("/").split("/")[-1]) if link else None
+
+
+def _link_title(entity, rel):
+    """ Gets the title of the given link """
+    link = entity.unwrap().searchLink(rel)
+    return link.getTitle() if link else None
+
+
+def _vdc_entry(vdc):
+    """ Builds the inventory entry of a virtual datacenter """
+    return ("vdc", vdc.getName(), vdc.getId(), (vdc.getId(),
+        _link_id(vdc, "datacenter"), vdc.getHypervisorType().name()))
+
+
+def _crawl_vdcs(context):
+    """ Yields the virtual datacenters """
+    for vdc in context.getCloudService().listVirtualDatacenters():
+        yield _vdc_entry(vdc)
+
+
+def _crawl_vapps(context, vms=False):
+    """ Yields the virtual datacenters and appliances, and optionally the
+    virtual machines """
+    for vdc in context.getCloudService().listVirtualDatacenters():
+        yield _vdc_entry(vdc)
+        for vapp in vdc.listVirtualAppliances():
+            yield ("vapp", vapp.getName(), vapp.getId(),
+                    (vdc.getId(), vapp.getId()))
+            if not vms:
+                continue
+            for vm in vapp.listVirtualMachines():
+                yield ("vm", vm.getInternalName(), vm.getId(),
+                        (vdc.getId(), vapp.getId(), vm.getId(),
+                            _link_title(vm, "virtualmachinetemplate")))
+
+
+def _crawl_vms(context):
+    """ Yields the virtual datacenters, appliances and machines """
+    return _crawl_vapps(context, True)
+
+
+def _crawl_volumes(context):
+    """ Yields the virtual datacenters and volumes """
+    for vdc in context.getCloudService().listVirtualDatacenters():
+        yield _vdc_entry(vdc)
+        for volume in vdc.listVolumes():
+            yield ("volume", volume.getName(), volume.getId(),
+                    (vdc.getId(), volume.getId()))
+
+
+def _crawl_infrastructure(context):
+    """ Yields the physical machines """
+    admin = context.getAdministrationService()
+    for dc in admin.listDatacenters():
+        for rack in dc.listRacks():
+            for machine in rack.listMachines():
+                yield ("machine", machine.getName(), machine.getId(),
+                        (dc.getId(), rack.getId(), machine.getId()))
+
+
+def _crawl_templates(context):
+    """ Yields the templates of the current enterprise """
+    admin = context.getAdministrationService()
+    for template in admin.getCurrentEnterprise().listTemplates():
+        yield ("template", template.getName(), template.getId(),
+                (_template_datacenter(template), template.getId(),
+                    _compatible_types(template)))
+
+
+def _get_vdc(context, ref):
+    return context.getCloudService().getVirtualDatacenter(ref[0])
+
+
+def _get_vapp(context, ref):
+    vdc = _get_vdc(context, ref)
+    return vdc.getVirtualAppliance(ref[1]) if vdc else None
+
+
+def _get_vm(context, ref):
+    vapp = _get_vapp(context, ref)
+    return vapp.getVirtualMachine(ref[2]) if vapp else None
+
+
+def _get_volume(context, ref):
+    vdc = _get_vdc(context, ref)
+    return vdc.getVolume(ref[1]) if vdc else None
+
+
+def _get_machine(context, ref):
+    dc = context.getAdministrationService().getDatacenter(ref[0])
+    rack = dc.getRack(ref[1]) if dc else None
+    return rack.getMachine(ref[2]) if rack else None
+
+
+def _get_template(context, ref):
+    admin = context.getAdministrationService()
+    dc = admin.getDatacenter(ref[0])
+    return admin.getCurrentEnterprise().getTemplateInRepository(dc, ref[1])
+
+
+# The crawler of each kind, and the kinds it indexes
+_CRAWLERS = {
+    "vdc": (_crawl_vdcs, ["vdc"]),
+    "vapp": (_crawl_vapps, ["vdc", "vapp"]),
+    "vm": (_crawl_vms, ["vdc", "vapp", "vm"]),
+    "volume": (_crawl_volumes, ["vdc", "volume"]),
+    "machine": (_crawl_infrastructure, ["machine"]),
+    "template": (_crawl_templates, ["template"]),
+}
+
+_RESOLVERS = {
+    "vdc": _get_vdc,
+    "vapp": _get_vapp,
+    "vm": _get_vm,
+    "volume": _get_volume,
+    "machine": _get_machine,
+    "template": _get_template,
+}
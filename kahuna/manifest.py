@@ -0,0 +1,92 @@
+#!/usr/bin/env jython
+
+import logging
+import os
+import pickle
+
+log = logging.getLogger('kahuna')
+
+# Increase it when the format of the cached manifest changes
+MANIFEST_VERSION = 1
+
+
+class PluginManifest:
+    """ Cached description of the available plugins.
+
+    It stores the documentation of each plugin and the names and help
+    of its commands, so the help can be printed without importing the
+    plugin modules (and all the Java classes they use). The cache is
+    rebuilt when any of the plugin files is modified.
+    """
+
+    def __init__(self, plugin_names, plugin_dir="kahuna/plugins",
+            cache_file=None):
+        """ Initializes the manifest for the given plugins """
+        self.__plugin_names = plugin_names
+        self.__plugin_dir = plugin_dir
+        self.__cache_file = cache_file or \
+                os.environ['HOME'] + "/.kahuna/plugins.cache"
+        self.__plugins = None
+
+    def load(self, loader):
+        """ Loads the manifest, rebuilding it if needed.
+
+        The loader is a function that returns a plugin instance given
+        its name. It is only called if the cached manifest is not valid.
+        """
+        if self.__plugins is None:
+            mtimes = self._mtimes()
+            cached = self._read()
+            if cached and cached.get("version") == MANIFEST_VERSION \
+                    and cached.get("mtimes") == mtimes:
+                self.__plugins = cached["plugins"]
+            else:
+                log.debug("Plugin manifest outdated. Rebuilding it...")
+                self.__plugins = self._build(loader)
+                self._write({"version": MANIFEST_VERSION, "mtimes": mtimes,
+                    "plugins": self.__plugins})
+        return self.__plugins
+
+    def _build(self, loader):
+        """ Builds the manifest loading all plugins """
+        plugins = {}
+        for name in self.__plugin_names:
+            plugin = loader(name)
+            commands = plugin._commands()
+            plugins[name] = (plugin.__doc__,
+                    [(command, commands[command].__doc__)
+                        for command in sorted(commands.iterkeys())])
+        return plugins
+
+    def _mtimes(self):
+        """ Gets the modification time of each plugin file """
+        mtimes = {}
+        for name in self.__plugin_names:
+            path = os.path.abspath("%s/%s.py" % (self.__plugin_dir, name))
+            mtimes[path] = os.path.getmtime(path)
+        return mtimes
+
+    def _read(self):
+        """ Reads the cached manifest, if any """
+        if not os.path.exists(self.__cache_file):
+            return None
+        try:
+            f = open(self.__cache_file, "rb")
+            try:
+                return pickle.load(f)
+            finally:
+                f.close()
+        except Exception, ex:
+            log.debug("Could not read the plugin manifest: %s" % ex)
+            return None
+
+    def _write(self, manifest):
+        """ Writes the manifest to the cache file """
+        try:
+            f = open(self.__cache_file, "wb")
+            try:
+                pickle.dump(manifest, f)
+            finally:
+                f.close()
+        except Exception, ex:
+            log.debug("Could not write the plugin manifest: %s" % ex)
@@ -3,6 +3,7 @@
 from __future__ import with_statement
 from contextlib import contextmanager
 import logging
+from manifest import PluginManifest
 from plugins import __all__
 
 log = logging.getLogger('kahuna')
@@ -13,6 +14,7 @@ class PluginManager:
     def __init__(self):
         """ Initialize the plugin list """
         self.__plugins = {}
+        self.__manifest = PluginManifest(__all__)
 
     def load_plugin(self, plugin_name):
         """ Loads a single plugin given its name """
@@ -28,45 +30,58 @@ class PluginManager:
             self.__plugins[plugin_name] = plugin
         return plugin
 
+    def commands(self, plugin_name):
+        """ Returns the names of the commands of the given plugin.
+
+        It uses the plugin manifest, so the plugin is not imported.
+        """
+        doc, commands = self._manifest()[plugin_name]
+        return [command for (command, description) in commands]
+
+    def has_command(self, plugin_name, command_name):
+        """ Checks if the given plugin exists and has the given command """
+        return plugin_name in __all__ and \
+                command_name in self.commands(plugin_name)
+
     def call(self, plugin_name, command_name, args):
         """ Encapsulate the call into a context already loaded. """
-        try:
-            plugin = self.load_plugin(plugin_name)
-            if not command_name:
-                self.help(plugin)
-            else:
-                try:
-                    command = plugin._commands()[command_name]
-                    with opencontext(plugin):
-                        return command(args)
-                except KeyError:
-                    # Command not found in plugin. Print only plugin help
-                    self.help(plugin)
-        except KeyError:
+        if not plugin_name in __all__:
             # Plugin not found, pring generic help
             self.help_all()
+        elif not self.has_command(plugin_name, command_name):
+            # Command not found in plugin. Print only plugin help
+            self.help(plugin_name)
+        else:
+            # Import the plugin only when one of its commands is run
+            plugin = self.load_plugin(plugin_name)
+            command = plugin._commands()[command_name]
+            with opencontext(plugin):
+                return command(args)
 
-    def help(self, plugin):
+    def help(self, plugin_name):
         """ Prints the help for the given plugin """
-        commands = plugin._commands()
-        plugin_name = plugin.__module__.split('.')[-1]
-        print "%s" % plugin.__doc__
-        for command in sorted(commands.iterkeys()):
-            print "   %s %s\t%s" % (plugin_name, command,
-                    commands[command].__doc__)
+        doc, commands = self._manifest()[plugin_name]
+        print "%s" % doc
+        for command, description in commands:
+            print "   %s %s\t%s" % (plugin_name, command, description)
 
     def help_all(self):
         """ Prints the help for all registered plugins """
         for name in sorted(__all__):
-            plugin = self.load_plugin(name)
-            self.help(plugin)
+            self.help(name)
             print
 
+    def _manifest(self):
+        """ Returns the plugin manifest, building it if needed """
+        return self.__manifest.load(self.load_plugin)
+
 
 @contextmanager
 def opencontext(plugin):
     """ Loads the context each plugin needs to be initialized
     in order to be executed """
     plugin._load_context()
-    yield
-    plugin._close_context()
+    try:
+        yield
+    finally:
+        plugin._close_context()
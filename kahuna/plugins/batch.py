@@ -0,0 +1,126 @@
+#!/usr/bin/env jython
+
+from __future__ import with_statement
+import logging
+import os
+import shlex
+import sys
+import threading
+import time
+from optparse import OptionParser
+from kahuna import daemon
+from kahuna.abstract import AbsPlugin
+from kahuna.pluginmanager import PluginManager
+from kahuna.sync import keep_snapshots
+from kahuna.utils.parallel import imap
+from kahuna.utils.prettyprint import PTable
+
+log = logging.getLogger('kahuna')
+
+
+class BatchPlugin(AbsPlugin):
+    """ Batch execution plugin """
+
+    def _load_context(self):
+        """ Each command borrows its own context from the pool """
+        pass
+
+    def run(self, args):
+        """ Runs the commands in a file (or stdin), one per line """
+        parser = OptionParser(usage="batch run <options>")
+        parser.add_option("-f", "--file", dest="file", default="-",
+                help="The file with the commands to run (default: stdin)")
+        parser.add_option("-p", "--parallel", dest="parallel", type="int",
+                default=1, help=("Number of commands to run concurrently. "
+                "Use it only if the commands do not depend on each other "
+                "(default: 1)"))
+        (options, args) = parser.parse_args(args)
+
+        if options.file == "-":
+            if daemon.current:
+                print "The daemon can not read from stdin. Use -f instead."
+                return 1
+            lines = sys.stdin.readlines()
+        else:
+            path = os.path.join(os.environ.get("KAHUNA_CWD", ""),
+                    options.file)
+            with open(path, "r") as f:
+                lines = f.readlines()
+
+        commands = []
+        for number, line in enumerate(lines):
+            command = parse_command(line)
+            if command:
+                commands.append((number + 1, command))
+        if not commands:
+            print "There are no commands to run"
+            return
+
+        log.debug("Running %s commands with %s threads" % (len(commands),
+            options.parallel))
+        keep_snapshots()
+        managers = threading.local()
+
+        def execute(line):
+            # Plugin instances keep the state of the running command, so
+            # each thread needs its own plugin manager
+            if not hasattr(managers, "pluginmanager"):
+                managers.pluginmanager = PluginManager()
+            number, command = line
+            start = time.time()
+            if not managers.pluginmanager.has_command(command[0],
+                    command[1]):
+                return ("unknown command", 0)
+            try:
+                ret = managers.pluginmanager.call(command[0], command[1],
+                        command[2:])
+            except SystemExit, ex:
+                # optparse exits on --help and on invalid options
+                ret = daemon.exit_code(ex)
+            return (ret, time.time() - start)
+
+        results = []
+        for line, result, error in imap(execute, commands, options.parallel):
+            results.append((line, result, error))
+        results.sort()
+        return pprint_summary(results)
+
+
+def parse_command(line):
+    """ Parses a line into a (plugin, command, args...) list.
+
+    Empty lines and comments are ignored. The command may optionally
+    start with 'kahuna'.
+    """
+    tokens = shlex.split(line, True)
+    if tokens and tokens[0] == "kahuna":
+        tokens = tokens[1:]
+    if len(tokens) < 2:
+        return None
+    return tokens
+
+
+def pprint_summary(results):
+    """ Prints the exit status of each command and returns the overall one """
+    table = PTable(["line", "command", "status", "time"])
+    failed = 0
+    for (number, command), result, error in results:
+        if error:
+            status = "ERROR (%s)" % error
+            elapsed = "-"
+        else:
+            ret, seconds = result
+            status = "FAILED (%s)" % ret if ret else "OK"
+            elapsed = "%.2f s" % seconds
+        if status != "OK":
+            failed += 1
+        table.add([number, " ".join(command), status, elapsed])
+    print
+    table.pprint()
+    print "%s commands run, %s failed" % (len(results), failed)
+    return 1 if failed else None
+
+
+def load():
+    """ Loads the current plugin """
+    return BatchPlugin()
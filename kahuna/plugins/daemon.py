@@ -0,0 +1,50 @@
+#!/usr/bin/env jython
+
+from optparse import OptionParser
+from kahuna import daemon
+from kahuna.abstract import AbsPlugin
+from kahuna.daemon import KahunaDaemon
+from kahuna.utils.prettyprint import PTable
+
+
+class DaemonPlugin(AbsPlugin):
+    """ Background daemon plugin """
+
+    def _load_context(self):
+        """ This plugin does not require an open context. """
+        pass
+
+    def start(self, args):
+        """ Starts a daemon that runs kahuna commands with warm contexts """
+        parser = OptionParser(usage="daemon start <options>")
+        parser.add_option("-p", "--port", dest="port", type="int",
+                default=0,
+                help="The local port to listen to (default: a random one)")
+        (options, args) = parser.parse_args(args)
+
+        if daemon.current:
+            print "The daemon is already running"
+            return
+        KahunaDaemon(options.port).serve()
+
+    def stop(self, args):
+        """ Stops the running daemon """
+        if not daemon.current:
+            print "The daemon is not running"
+            return
+        daemon.current.stop()
+        print "Stopping the daemon"
+
+    def status(self, args):
+        """ Prints the status of the running daemon """
+        if not daemon.current:
+            print "The daemon is not running"
+            return
+        table = PTable(["property", "value"])
+        [table.add([name, value]) for (name, value) in daemon.current.status()]
+        table.pprint()
+
+
+def load():
+    """ Loads the current plugin """
+    return DaemonPlugin()
@@ -1,20 +1,32 @@
 #!/usr/bin/env jython
 
-from environment.cloud.compute import cleanup_cloud_compute
+import logging
+from optparse import OptionParser
 from environment.cloud.compute import create_cloud_compute
 from environment.cloud.network import setup_cloud_network
 from environment.cloud.storage import create_cloud_storage
+from environment.cleanup import cleanup_environment
 from environment.config.sysconfig import apply_default_configuration
-from environment.infrastructure.compute import cleanup_infrastructure_compute
-from environment.infrastructure.compute import create_infrastructure_compute
-from environment.infrastructure.network import create_infrastructure_network
-from environment.infrastructure.storage import create_infrastructure_storage
-from environment.users.tenants import cleanup_default_tenants
+from environment.infrastructure.compute \
+        import create_infrastructure_datacenter
+from environment.infrastructure.compute \
+        import create_infrastructure_machines
+from environment.infrastructure.compute import create_infrastructure_rack
+from environment.infrastructure.network import create_external_network
+from environment.infrastructure.network import create_public_network
+from environment.infrastructure.network import create_unmanaged_network
+from environment.infrastructure.storage \
+        import configure_infrastructure_tiers
+from environment.infrastructure.storage import create_infrastructure_device
+from environment.infrastructure.storage import create_infrastructure_pool
 from environment.users.tenants import create_default_tenants
 from kahuna.abstract import AbsPlugin
 from kahuna.config import ConfigLoader
-from org.jclouds.abiquo.domain.exception import AbiquoException
-from org.jclouds.rest import AuthorizationException
+from kahuna.inventory import inventory
+from kahuna.utils.parallel import TaskGraph
+from kahuna.utils.prettyprint import pprint_steps
+
+log = logging.getLogger('kahuna')
 
 
 class EnvironmentPlugin(AbsPlugin):
@@ -24,26 +36,78 @@ class EnvironmentPlugin(AbsPlugin):
 
     def create(self, args):
         """ Creates the environment """
+        parser = OptionParser(usage="env create <options>")
+        parser.add_option("-p", "--parallel", dest="parallel", type="int",
+                default=4, help=("Number of steps to run concurrently "
+                "(default: 4)"))
+        (options, args) = parser.parse_args(args)
+
+        config = self.__config
+        context = self._context
+        graph = TaskGraph()
+        graph.add("configuration",
+                lambda: apply_default_configuration(config, context))
+        graph.add("datacenter",
+                lambda: create_infrastructure_datacenter(config, context))
+        graph.add("rack",
+                lambda dc: create_infrastructure_rack(config, context, dc),
+                ["datacenter"])
+        graph.add("machines", lambda rack:
+                create_infrastructure_machines(config, context, rack),
+                ["rack"])
+        graph.add("tiers", lambda dc:
+                configure_infrastructure_tiers(config, context, dc),
+                ["datacenter"])
+        graph.add("storage device", lambda dc:
+                create_infrastructure_device(config, context, dc),
+                ["datacenter"])
+        graph.add("storage pool", lambda device, tier:
+                create_infrastructure_pool(config, context, device, tier),
+                ["storage device", "tiers"])
+        graph.add("public network",
+                lambda dc: create_public_network(config, context, dc),
+                ["datacenter"])
+        graph.add("external network",
+                lambda dc: create_external_network(config, context, dc),
+                ["datacenter"])
+        graph.add("unmanaged network",
+                lambda dc: create_unmanaged_network(config, context, dc),
+                ["datacenter"])
+        graph.add("tenants",
+                lambda dc: create_default_tenants(config, context, dc),
+                ["datacenter"])
+        # The virtual datacenter needs the hypervisors to be added
+        graph.add("cloud compute", lambda dc, machines:
+                create_cloud_compute(config, context, dc),
+                ["datacenter", "machines"])
+        graph.add("cloud storage", lambda vdc, pool:
+                create_cloud_storage(config, context, vdc),
+                ["cloud compute", "storage pool"])
+        graph.add("cloud network", lambda vdc, network:
+                setup_cloud_network(config, context, vdc),
+                ["cloud compute", "public network"])
+
+        log.info("### Creating the environment ###")
         try:
-            apply_default_configuration(self.__config, self._context)
-            dc = create_infrastructure_compute(self.__config, self._context)
-            create_infrastructure_storage(self.__config, self._context, dc)
-            create_infrastructure_network(self.__config, self._context, dc)
-            create_default_tenants(self.__config, self._context, dc)
-            vdc = create_cloud_compute(self.__config, self._context, dc)
-            create_cloud_storage(self.__config, self._context, vdc)
-            setup_cloud_network(self.__config, self._context, vdc)
-        except (AbiquoException, AuthorizationException), ex:
-            print "Error: %s" % ex.getMessage()
+            steps = graph.run(options.parallel)
+        finally:
+            inventory(self._context).clear()
+        return pprint_steps(steps)
 
     def clean(self, args):
         """ Cleans up the environment """
+        parser = OptionParser(usage="env clean <options>")
+        parser.add_option("-p", "--parallel", dest="parallel", type="int",
+                default=4, help=("Number of entities to remove concurrently "
+                "(default: 4)"))
+        (options, args) = parser.parse_args(args)
+
         try:
-            cleanup_cloud_compute(self.__config, self._context)
-            cleanup_default_tenants(self.__config, self._context)
-            cleanup_infrastructure_compute(self.__config, self._context)
-        except (AbiquoException, AuthorizationException), ex:
-            print "Error: %s" % ex.getMessage()
+            steps = cleanup_environment(self.__config, self._context,
+                    options.parallel)
+        finally:
+            inventory(self._context).clear()
+        return pprint_steps(steps)
 
 
 def load():
@@ -0,0 +1,87 @@
+#!/usr/bin/env jython
+
+import logging
+import time
+from java.lang import Throwable
+from kahuna.plugins.environment.users.tenants import list_custom_roles
+from kahuna.plugins.environment.users.tenants import list_tenant_enterprises
+from kahuna.utils.parallel import imap
+
+log = logging.getLogger('kahuna')
+
+
+def cleanup_environment(config, context, parallelism):
+    """ Removes all the entities of the environment.
+
+    Entities are removed level by level, so each level only has entities
+    nothing else depends on once the previous levels are removed. The
+    entities of a level are removed concurrently, using at most the given
+    number of threads. If any of them can not be removed, the following
+    levels are skipped.
+
+    Returns a (level, status, seconds, error) tuple for each level.
+    """
+    steps = []
+    failed = None
+    for kinds in _levels(context):
+        name = ", ".join([kind for kind, lister in kinds])
+        if failed:
+            steps.append((name, "SKIPPED", None, "Depends on %s" % failed))
+            continue
+        start = time.time()
+        try:
+            entities = []
+            for kind, lister in kinds:
+                entities.extend(lister())
+        except (Exception, Throwable), ex:
+            steps.append((name, "ERROR", time.time() - start, ex))
+            failed = name
+            continue
+
+        log.info("### Removing %s: %s entities ###" % (name, len(entities)))
+        errors = 0
+        for entity, result, error in imap(lambda e: e.delete(), entities,
+                parallelism):
+            if error:
+                errors += 1
+                log.warn("Could not remove %s: %s" % (entity.getName(),
+                    error))
+            else:
+                log.debug("Removed %s" % entity.getName())
+        log.info("Removed %s of %s entities" % (len(entities) - errors,
+            len(entities)))
+
+        if errors:
+            steps.append((name, "ERROR", time.time() - start,
+                "%s entities could not be removed" % errors))
+            failed = name
+        else:
+            steps.append((name, "OK", time.time() - start, None))
+    return steps
+
+
+def _levels(context):
+    """ Returns the (kind, lister) pairs of each level, in removal order """
+    admin = context.getAdministrationService()
+    cloud = context.getCloudService()
+
+    def children(parents, getter):
+        return lambda: [child for parent in parents()
+                for child in getter(parent)]
+
+    return [
+        [("virtual appliances", children(cloud.listVirtualDatacenters,
+            lambda vdc: vdc.listVirtualAppliances()))],
+        [("volumes", children(cloud.listVirtualDatacenters,
+            lambda vdc: vdc.listVolumes()))],
+        [("virtual datacenters", cloud.listVirtualDatacenters)],
+        # Deleting an enterprise also deletes its users
+        [("enterprises", lambda: list_tenant_enterprises(context)),
+         ("storage devices", children(admin.listDatacenters,
+            lambda dc: dc.listStorageDevices()))],
+        [("roles", lambda: list_custom_roles(context)),
+         ("networks", children(admin.listDatacenters,
+            lambda dc: dc.listNetworks()))],
+        # Deleting a datacenter also deletes its racks and machines
+        [("datacenters", admin.listDatacenters)],
+    ]
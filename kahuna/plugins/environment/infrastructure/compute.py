@@ -5,6 +5,7 @@ from kahuna.plugins.environment.infrastructure.network \
         import cleanup_infrastructure_network
 from kahuna.plugins.environment.infrastructure.storage \
         import cleanup_infrastructure_storage
+from kahuna.utils.parallel import imap
 from com.abiquo.model.enumerator import HypervisorType
 from org.jclouds.abiquo.config import AbiquoEdition
 from org.jclouds.abiquo.domain.infrastructure import Datacenter
@@ -12,6 +13,9 @@ from org.jclouds.abiquo.domain.infrastructure import Rack
 
 log = logging.getLogger('kahuna')
 
+# Default number of machines discovered at the same time
+DISCOVERY_PARALLELISM = 4
+
 
 class InfrastructureCompute:
     """ Provides access to infrastructure compute features """
@@ -73,27 +77,65 @@ class InfrastructureCompute:
 def create_infrastructure_compute(config, context):
     """ Creates the default infrastructure compute entities. """
     log.info("### Configuring infrastructure ###")
+    dc = create_infrastructure_datacenter(config, context)
+    rack = create_infrastructure_rack(config, context, dc)
+    create_infrastructure_machines(config, context, rack)
+    return dc
+
+
+def create_infrastructure_datacenter(config, context):
+    """ Creates the default datacenter """
     comp = InfrastructureCompute(context)
     rs_address = config.get("datacenter", "rs") \
             if config.has_option("datacenter", "rs") \
             else context.getApiContext().getEndpoint().getHost()
-    dc = comp.create_datacenter(config.get("datacenter", "name"),
+    return comp.create_datacenter(config.get("datacenter", "name"),
             config.get("datacenter", "location"), rs_address)
-    rack = comp.create_rack(dc, config.get("rack", "name"),
+
+
+def create_infrastructure_rack(config, context, dc):
+    """ Creates the default rack in the given datacenter """
+    comp = InfrastructureCompute(context)
+    return comp.create_rack(dc, config.get("rack", "name"),
             config.getint("rack", "vlan-min"),
             config.getint("rack", "vlan-max"),
             config.getint("rack", "nrsq"))
 
+
+def create_infrastructure_machines(config, context, rack):
+    """ Adds the configured physical machines to the given rack.
+
+    Machines are discovered concurrently, but no more than the number set
+    in the 'discovery' option of the datacenter, so the remote services
+    are not overloaded. The machines that can not be added are reported
+    and the rest are added anyway.
+    """
+    comp = InfrastructureCompute(context)
     sections = filter(lambda s: s.startswith("machine"), config.sections())
-    for section in sections:
-        comp.create_machine(rack,
+    parallelism = config.getint("datacenter", "discovery") \
+            if config.has_option("datacenter", "discovery") \
+            else DISCOVERY_PARALLELISM
+
+    def add(section):
+        return comp.create_machine(rack,
                 HypervisorType.valueOf(config.get(section, "type")),
                 config.get(section, "address"),
                 config.get(section, "user"),
                 config.get(section, "password"),
                 config.get(section, "datastore"),
                 config.get(section, "vswitch"))
-    return dc
+
+    machines = []
+    for section, machine, error in imap(add, sections, parallelism):
+        if error:
+            log.warn("Could not add machine %s: %s" %
+                    (config.get(section, "address"), error))
+        else:
+            machines.append(machine)
+    log.info("Added %s of %s machines" % (len(machines), len(sections)))
+    if sections and not machines:
+        raise Exception("None of the machines could be added")
+    return machines
 
 
 def cleanup_infrastructure_compute(config, context):
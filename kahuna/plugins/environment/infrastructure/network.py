@@ -70,31 +70,50 @@ class InfrastructureNetwork:
 def create_infrastructure_network(config, context, dc):
     """ Creates the default infrastructure network entities """
     log.info("### Configuring networking ###")
-    admin = context.getAdministrationService()
-    enterprise = admin.findEnterprise(EnterprisePredicates.name("Abiquo"))
+    pubnet = create_public_network(config, context, dc)
+    create_external_network(config, context, dc)
+    create_unmanaged_network(config, context, dc)
+    return pubnet
+
+
+def create_public_network(config, context, dc):
+    """ Creates the default public network in the given datacenter """
     networking = InfrastructureNetwork(context)
-    pubnet = networking.create_public_network(dc,
+    return networking.create_public_network(dc,
             config.get("public network", "name"),
             config.get("public network", "address"),
             config.getint("public network", "mask"),
             config.get("public network", "gateway"),
             config.getint("public network", "tag"),
             config.get("public network", "dns"))
-    networking.create_external_network(dc, enterprise,
+
+
+def create_external_network(config, context, dc):
+    """ Creates the default external network of the 'Abiquo' enterprise """
+    admin = context.getAdministrationService()
+    enterprise = admin.findEnterprise(EnterprisePredicates.name("Abiquo"))
+    networking = InfrastructureNetwork(context)
+    return networking.create_external_network(dc, enterprise,
             config.get("external network", "name"),
             config.get("external network", "address"),
             config.getint("external network", "mask"),
             config.get("external network", "gateway"),
             config.getint("external network", "tag"),
             config.get("external network", "dns"))
-    networking.create_unmanaged_network(dc, enterprise,
+
+
+def create_unmanaged_network(config, context, dc):
+    """ Creates the default unmanaged network of the 'Abiquo' enterprise """
+    admin = context.getAdministrationService()
+    enterprise = admin.findEnterprise(EnterprisePredicates.name("Abiquo"))
+    networking = InfrastructureNetwork(context)
+    return networking.create_unmanaged_network(dc, enterprise,
             config.get("unmanaged network", "name"),
             config.get("unmanaged network", "address"),
             config.getint("unmanaged network", "mask"),
             config.get("unmanaged network", "gateway"),
             config.getint("unmanaged network", "tag"),
             config.get("unmanaged network", "dns"))
-    return pubnet
 
 
 def cleanup_infrastructure_network(config, dc):
@@ -62,8 +62,20 @@ class InfrastructureStorage:
 def create_infrastructure_storage(config, context, dc):
     """ Creates the default infrastructure storage entities """
     log.info("### Configuring storage ###")
+    tier = configure_infrastructure_tiers(config, context, dc)
+    device = create_infrastructure_device(config, context, dc)
+    create_infrastructure_pool(config, context, device, tier)
+
+
+def configure_infrastructure_tiers(config, context, dc):
+    """ Enables the default tier of the given datacenter """
+    storage = InfrastructureStorage(context)
+    return storage.configure_tiers(dc, config.get("tier", "name"))
+
+
+def create_infrastructure_device(config, context, dc):
+    """ Creates the default storage device in the given datacenter """
     storage = InfrastructureStorage(context)
-    tier = storage.configure_tiers(dc, config.get("tier", "name"))
     try:
         user = config.get("device", "user")
         password = config.get("device", "password")
@@ -75,13 +87,17 @@ def create_infrastructure_storage(config, context, dc):
     device_spec = dc.findSupportedStorageDevice(
             StorageDeviceMetadataPredicates.type(device_type))
 
-    device = storage.create_device(dc, config.get("device", "name"),
+    return storage.create_device(dc, config.get("device", "name"),
         device_spec,
         config.get("device", "address"),
         config.get("device", "address"),
         user, password)
 
-    storage.create_pool(device, tier, config.get("pool", "name"))
+
+def create_infrastructure_pool(config, context, device, tier):
+    """ Adds the default pool of the given device to the given tier """
+    storage = InfrastructureStorage(context)
+    return storage.create_pool(device, tier, config.get("pool", "name"))
 
 
 def cleanup_infrastructure_storage(config, datacenter):
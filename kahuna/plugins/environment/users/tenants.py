@@ -87,22 +87,31 @@ def create_default_tenants(config, context, dc):
 def cleanup_default_tenants(config, context):
     """ Cleans up a previously created default tenants """
     log.info("### Cleaning up tenants ###")
-    admin = context.getAdministrationService()
-    enterprises = admin.listEnterprises(
-            Predicates.not(EnterprisePredicates.name("Abiquo")))
-    for enterprise in enterprises:
+    for enterprise in list_tenant_enterprises(context):
         # This will remove the enterprise and all users
         # (if none of them is a Cloud Admin)
         log.info("Removing enterprise %s and all users..."  \
                 % enterprise.getName())
         enterprise.delete()
 
+    # This will remove all non default roles
+    for role in list_custom_roles(context):
+        log.info("Removing role %s..." % role.getName())
+        role.delete()
+
+
+def list_tenant_enterprises(context):
+    """ Lists all enterprises but the default one """
+    admin = context.getAdministrationService()
+    return admin.listEnterprises(
+            Predicates.not(EnterprisePredicates.name("Abiquo")))
+
+
+def list_custom_roles(context):
+    """ Lists all roles but the default ones """
+    admin = context.getAdministrationService()
     rolefilter = Predicates.not(Predicates.or(
         RolePredicates.name("CLOUD_ADMIN"),
         RolePredicates.name("ENTERPRISE_ADMIN"),
         RolePredicates.name("USER")))
-    roles = admin.listRoles(rolefilter)
-    # This will remove all non default roles
-    for role in roles:
-        log.info("Removing role %s..." % role.getName())
-        role.delete()
+    return admin.listRoles(rolefilter)
@@ -0,0 +1,54 @@
+#!/usr/bin/env jython
+
+import logging
+from optparse import OptionParser
+from kahuna.abstract import AbsPlugin
+from kahuna.inventory import GROUPS, inventory
+from kahuna.sync import sync
+from kahuna.utils.prettyprint import pprint_inventory
+from kahuna.utils.prettyprint import pprint_sync_stats
+from org.jclouds.abiquo.domain.exception import AbiquoException
+from org.jclouds.rest import AuthorizationException
+
+log = logging.getLogger('kahuna')
+
+
+class InventoryPlugin(AbsPlugin):
+    """ Local inventory plugin """
+
+    def refresh(self, args):
+        """ Fetches again the cached names and ids of the entities """
+        parser = OptionParser(usage="inventory refresh <options>")
+        parser.add_option("-g", "--group", dest="groups", action="append",
+                help=("The group of entities to refresh: %s. Can be used "
+                "several times (default: all)" %
+                ", ".join(sorted(GROUPS.keys()))))
+        (options, args) = parser.parse_args(args)
+        for group in options.groups or []:
+            if group not in GROUPS:
+                print "Unknown group: %s" % group
+                return
+
+        try:
+            inv = inventory(self._context)
+            inv.refresh(options.groups)
+            pprint_inventory(inv.status())
+        except (AbiquoException, AuthorizationException), ex:
+            print "Error: %s" % ex.getMessage()
+
+    def clear(self, args):
+        """ Removes the cached names and ids of the entities """
+        inventory(self._context).clear()
+
+    def status(self, args):
+        """ Shows the number and age of the cached entities """
+        pprint_inventory(inventory(self._context).status())
+
+    def stats(self, args):
+        """ Shows the traffic of the listings since the process started """
+        pprint_sync_stats(sync(self._context).stats())
+
+
+def load():
+    """ Loads the current plugin """
+    return InventoryPlugin()
@@ -1,10 +1,19 @@
 #!/usr/bin/env jython
 
+from __future__ import with_statement
 import logging
 import ConfigParser
 from kahuna.abstract import AbsPlugin
-from kahuna.session import ContextLoader
 from kahuna.config import ConfigLoader
+from kahuna.inventory import inventory
+from kahuna.sync import list_machines
+from kahuna.utils.hypervisors import discover_machine
+from kahuna.utils.output import Output
+from kahuna.utils.output import add_output_options
+from kahuna.utils.parallel import TaskTimeout
+from kahuna.utils.parallel import imap
+from kahuna.utils.prettyprint import MACHINE_COLUMNS
+from kahuna.utils.prettyprint import parse_columns
 from kahuna.utils.prettyprint import pprint_machines
 from optparse import OptionParser
 from org.jclouds.abiquo.config import AbiquoEdition
@@ -37,6 +46,16 @@ class MachinePlugin(AbsPlugin):
                 action='store', dest='host')
         parser.add_option('-a', '--all', help='check all machines',
                 action='store_true', dest='a')
+        parser.add_option('-p', '--parallelism', type='int', default=10,
+                help='number of machines to check concurrently with '
+                '--all (default 10)', action='store', dest='parallelism')
+        parser.add_option('-t', '--timeout', type='int', default=60,
+                help='seconds to wait for each machine with --all '
+                '(default 60)', action='store', dest='timeout')
+        parser.add_option('--columns', dest='columns',
+                help='comma separated list of columns to show: %s' %
+                ','.join([column[0] for column in MACHINE_COLUMNS]))
+        add_output_options(parser)
         (options, args) = parser.parse_args(args)
         all_true = options.a
         name = options.name
@@ -45,24 +64,51 @@ class MachinePlugin(AbsPlugin):
         if not name and not host and not all_true:
             parser.print_help()
             return
+        try:
+            columns = parse_columns(options.columns, MACHINE_COLUMNS)
+        except ValueError, ex:
+            print "Error %s" % ex
+            return
 
         try:
             admin = self._context.getAdministrationService()
             if all_true:
                 machines = admin.listMachines()
                 log.debug("%s machines found." % str(len(machines)))
-                [self._checkMachine for machine in machines]
-                pprint_machines(machines)
+                with Output(options.output, options.output_file) as output:
+                    pprint_machines(self._checkMachines(machines,
+                        options.parallelism, options.timeout), stream=True,
+                        columns=columns, output=output)
             else:
                 if name:
-                    machine = admin.findMachine(MachinePredicates.name(name))
+                    machine = inventory(self._context).find("machine",
+                            name)
                 else:
                     machine = admin.findMachine(MachinePredicates.ip(host))
                 self._checkMachine(machine)
-                pprint_machines([machine])
+                with Output(options.output, options.output_file) as output:
+                    pprint_machines([machine], columns=columns,
+                            output=output)
         except (AbiquoException, AuthorizationException), ex:
             print "Error %s" % ex.getMessage()
 
+    def _checkMachines(self, machines, parallelism, timeout):
+        """ Checks the given machines concurrently.
+
+        Machines are yielded as soon as they are checked.
+        """
+        checks = imap(self._checkMachine, machines, parallelism, timeout)
+        for machine, result, error in checks:
+            if isinstance(error, TaskTimeout):
+                log.warn("Could not check %s: %s" % (machine.getName(),
+                    error))
+                yield _UncheckedMachine(machine, "TIMED OUT")
+                continue
+            if error:
+                log.warn("Could not check %s: %s" % (machine.getName(),
+                    error))
+            yield machine
+
     def _checkMachine(self, machine):
         try:
             if not machine:
@@ -75,7 +121,9 @@ class MachinePlugin(AbsPlugin):
 
     def create(self, args):
         """ Create a physical machine in abiquo """
-        parser = OptionParser(usage="machine create --host <host> <options>")
+        parser = OptionParser(usage="machine create --host <host> <options>\n"
+                "       machine create --range <first ip>-<last ip> "
+                "--type <type> <options>")
 
         # create options
         parser.add_option('-i', '--host',
@@ -102,19 +150,40 @@ class MachinePlugin(AbsPlugin):
         parser.add_option('-D', '--datacenter',
                 help='datacenter\' name where adds the machine',
                 action='store', dest='datacenter')
+        parser.add_option('-R', '--range',
+                help='range of ips of the machines to create, as '
+                     '<first ip>-<last ip>. Requires --type',
+                action='store', dest='range')
+        parser.add_option('--chunk-size', type='int', default=16,
+                help='number of ips discovered in each request with '
+                     '--range (default 16)',
+                action='store', dest='chunk_size')
+        parser.add_option('--parallelism', type='int', default=2,
+                help='number of concurrent requests with --range '
+                     '(default 2)',
+                action='store', dest='parallelism')
         (options, args) = parser.parse_args(args)
 
         # parse options
         host = options.host
-        if not host:
+        if not host and not options.range:
             parser.print_help()
             return
+        if options.range:
+            if not options.hypervisor:
+                print "The --type option is required with --range"
+                return
+            try:
+                ips = parse_range(options.range)
+            except ValueError, ex:
+                print "Error %s" % ex
+                return
+            # Machines in a range use the global configuration
+            host = "global"
 
         user = self._getConfig(options, host, "user")
         psswd = self._getConfig(options, host, "psswd")
         rsip = self._getConfig(options, host, "remoteservicesip")
-        dsname = self._getConfig(options, host, "datastore")
-        vswitch = self._getConfig(options, host, "vswitch")
         dcname = self._getConfig(options, host, "datacenter")
         hypervisor = options.hypervisor
 
@@ -155,23 +224,20 @@ class MachinePlugin(AbsPlugin):
                     rack.save()
                 log.debug("Datacenter '%s' found" % dcname)
 
+            if options.range:
+                self._createRange(options, dc, rack, ips,
+                        HypervisorType.valueOf(hypervisor), user, psswd)
+                return
+
             # discover machine
+            types = None
             if hypervisor:
-                hypTypes = [HypervisorType.valueOf(hypervisor)]
-            else:
-                hypTypes = HypervisorType.values()
-
-            machine = None
-            for hyp in hypTypes:
-                try:
-                    log.debug("Trying hypervisor %s" % hyp.name())
-                    machine = dc.discoverSingleMachine(host, hyp, user, psswd)
-                    break
-                except (AbiquoException, HttpResponseException), ex:
-                    if ex.hasError("NC-3") or ex.hasError("RS-2"):
-                        print ex.getMessage().replace("\n", "")
-                        return
-                    log.debug(ex.getMessage().replace("\n", ""))
+                types = [HypervisorType.valueOf(hypervisor)]
+            try:
+                machine = discover_machine(dc, host, user, psswd, types)
+            except (AbiquoException, HttpResponseException), ex:
+                print ex.getMessage().replace("\n", "")
+                return
 
             if not machine:
                 print "Not machine found in %s" % host
@@ -180,25 +246,10 @@ class MachinePlugin(AbsPlugin):
             log.debug("Machine %s of type %s found"
                     % (machine.getName(), machine.getType().name()))
 
-            # enabling datastore
-            ds = machine.findDatastore(dsname)
-            if not ds:
-                print "Missing datastore %s in machine" % dsname
-                return
-            ds.setEnabled(True)
-
-            # setting virtual switch
-            vs = machine.findAvailableVirtualSwitch(vswitch)
-            if not vs:
-                print "Missing virtual switch %s in machine" % vswitch
+            error = self._setupMachine(options, host, dc, rack, machine)
+            if error:
+                print error
                 return
-            nst = dc.defaultNetworkServiceType()
-            vs.setNetworkServiceType(nst)
-
-            # saving machine
-            machine.setRack(rack)
-            machine.save()
-            log.debug("Machine saved")
             pprint_machines([machine])
 
         except (AbiquoException, AuthorizationException), ex:
@@ -207,6 +258,79 @@ class MachinePlugin(AbsPlugin):
             else:
                 print "Error: %s " % ex.getMessage()
 
+    def _createRange(self, options, dc, rack, ips, hypervisor, user, psswd):
+        """ Discovers and saves the machines in the given ips.
+
+        The range is discovered in chunks, each of them with a single
+        request to the remote services, and then the machines found are
+        saved. Both are done concurrently.
+        """
+        size = max(options.chunk_size, 1)
+        chunks = [ips[i:i + size] for i in range(0, len(ips), size)]
+
+        def discover(chunk):
+            log.debug("Discovering %s machines from %s to %s" %
+                    (hypervisor.name(), chunk[0], chunk[-1]))
+            return dc.discoverMultipleMachines(chunk[0], chunk[-1],
+                    hypervisor, user, psswd)
+
+        machines = []
+        for chunk, found, error in imap(discover, chunks,
+                options.parallelism):
+            if error:
+                log.warn("Could not discover %s-%s: %s" % (chunk[0],
+                    chunk[-1], error))
+            else:
+                machines.extend(found)
+        if not machines:
+            print "Not machine found in %s" % options.range
+            return
+        log.debug("%s machines found in %s" % (len(machines), options.range))
+
+        def save(machine):
+            error = self._setupMachine(options, machine.getIp(), dc, rack,
+                    machine)
+            if error:
+                raise Exception(error)
+
+        saved = []
+        for machine, result, error in imap(save, machines,
+                options.parallelism):
+            if error:
+                print "Could not add %s: %s" % (machine.getIp(), error)
+            else:
+                saved.append(machine)
+        pprint_machines(saved)
+        print "%s of %s machines found added" % (len(saved), len(machines))
+
+    def _setupMachine(self, options, host, dc, rack, machine):
+        """ Enables the datastore and virtual switch and saves the machine.
+
+        Returns the reason the machine could not be saved, if any.
+        """
+        # enabling datastore
+        dsname = self._getConfig(options, host, "datastore")
+        ds = machine.findDatastore(dsname)
+        if not ds:
+            return "Missing datastore %s in machine" % dsname
+        ds.setEnabled(True)
+
+        # setting virtual switch
+        vswitch = self._getConfig(options, host, "vswitch")
+        vs = machine.findAvailableVirtualSwitch(vswitch)
+        if not vs:
+            return "Missing virtual switch %s in machine" % vswitch
+        nst = dc.defaultNetworkServiceType()
+        vs.setNetworkServiceType(nst)
+
+        # saving machine
+        machine.setRack(rack)
+        machine.save()
+        inventory(self._context).remember("machine", machine.getName(),
+                machine.getId(), (dc.getId(), rack.getId(), machine.getId()))
+        log.debug("Machine saved")
+        return None
+
     def delete(self, args):
         """ Remove a physical machine from abiquo """
         parser = OptionParser(usage="machine delete <options>")
@@ -227,7 +351,7 @@ class MachinePlugin(AbsPlugin):
         try:
             admin = self._context.getAdministrationService()
             if name:
-                machine = admin.findMachine(MachinePredicates.name(name))
+                machine = inventory(self._context).find("machine", name)
             else:
                 machine = admin.findMachine(MachinePredicates.ip(host))
             if not machine:
@@ -235,6 +359,7 @@ class MachinePlugin(AbsPlugin):
                 return
             name = machine.getName()
             machine.delete()
+            inventory(self._context).forget("machine", name)
             log.debug("Machine %s deleted succesfully" % name)
 
         except (AbiquoException, AuthorizationException), ex:
@@ -242,15 +367,24 @@ class MachinePlugin(AbsPlugin):
 
     def list(self, args):
         """ List physical machines from abiquo """
-        context = ContextLoader().load()
+        parser = OptionParser(usage="machine list <options>")
+        parser.add_option('--columns', dest='columns',
+                help='comma separated list of columns to show: %s' %
+                ','.join([column[0] for column in MACHINE_COLUMNS]))
+        add_output_options(parser)
+        (options, args) = parser.parse_args(args)
         try:
-            admin = context.getAdministrationService()
-            machines = admin.listMachines()
-            pprint_machines(machines)
+            columns = parse_columns(options.columns, MACHINE_COLUMNS)
+        except ValueError, ex:
+            print "Error %s" % ex
+            return
+
+        try:
+            machines = list_machines(self._context)
+            with Output(options.output, options.output_file) as output:
+                pprint_machines(machines, columns=columns, output=output)
         except (AbiquoException, AuthorizationException), ex:
             print "Error %s" % ex.getMessage()
-        finally:
-            context.close()
 
     def _getConfig(self, options, host, prop):
         """ Gets a value from config or options """
@@ -263,6 +397,58 @@ class MachinePlugin(AbsPlugin):
             return self.__config.get("global", prop)
 
 
+class _UncheckedMachine:
+    """ A machine whose state could not be checked.
+
+    It behaves as the given machine, but its state is the reason why it
+    could not be checked.
+    """
+
+    def __init__(self, machine, reason):
+        self.__machine = machine
+        self.__state = _UncheckedState(reason)
+
+    def getState(self):
+        return self.__state
+
+    def __getattr__(self, name):
+        return getattr(self.__machine, name)
+
+
+class _UncheckedState:
+    """ The state of a machine that could not be checked """
+
+    def __init__(self, reason):
+        self.__reason = reason
+
+    def name(self):
+        return self.__reason
+
+
+def parse_range(text):
+    """ Returns the ips in the given <first ip>-<last ip> range """
+    try:
+        first, last = [_ip_to_int(ip) for ip in text.split("-")]
+    except ValueError:
+        raise ValueError("Invalid ip range: %s" % text)
+    if first > last:
+        raise ValueError("Invalid ip range: %s" % text)
+    return [_int_to_ip(ip) for ip in range(first, last + 1)]
+
+
+def _ip_to_int(ip):
+    """ Converts an IPv4 address to a number """
+    parts = [int(part) for part in ip.strip().split(".")]
+    if len(parts) != 4 or [part for part in parts if part < 0 or part > 255]:
+        raise ValueError("Invalid ip: %s" % ip)
+    return reduce(lambda value, part: value * 256 + part, parts, 0)
+
+
+def _int_to_ip(value):
+    """ Converts a number to an IPv4 address """
+    return ".".join([str(value >> shift & 255) for shift in (24, 16, 8, 0)])
+
+
 def load():
     """ Loads the current plugin """
     return MachinePlugin()
@@ -11,6 +11,7 @@ from kahuna.utils import ntp
 from kahuna.utils import rabbitmq
 from kahuna.utils import redis
 from kahuna.utils import ssh
+from kahuna.utils.provisioning import NodeProvisioner
 from kahuna.utils.tomcat import TomcatScripts
 from com.google.common.base import Predicate
 from com.google.common.collect import Iterables
@@ -118,6 +119,9 @@ class ScalabilityPlugin(AbsPlugin):
         parser.add_option('-c', '--count', type="int", default=1,
                 help='Number of nodes to deploy (default 1)',
                 action='store', dest='count')
+        parser.add_option('-P', '--parallelism', type="int", default=5,
+                help='Number of nodes to provision concurrently (default 5)',
+                action='store', dest='parallelism')
         (options, args) = parser.parse_args(args)
 
         if options.file and options.jenkins:
@@ -156,21 +160,9 @@ class ScalabilityPlugin(AbsPlugin):
             log.info("Deploying %s %s nodes to %s..." % (options.count,
                 template.getImage().getName(), vdc.getDescription()))
 
-            # Due to the IpPoolManagement concurrency issue, we need to deploy
-            # the nodes one by one
-            nodes = []
-            responses = []
-            for i in xrange(options.count):
-                node = Iterables.getOnlyElement(
-                    compute.createNodesInGroup("kahuna-api", 1, template))
-                log.info("Created node %s at %s" % (node.getName(),
-                    Iterables.getOnlyElement(node.getPublicAddresses())))
+            def configure(i, node):
                 if options.file:
                     ssh.upload(self._context, node, "/tmp", options.file)
-                nodes.append(node)
-
-                log.info("Cooking %s with Chef in the background..." %
-                    node.getName())
                 tomcat_config = {
                     "rabbit": options.datanode,
                     "redis": options.datanode,
@@ -189,21 +181,19 @@ class ScalabilityPlugin(AbsPlugin):
                         options.jenkins, "api"))
                 bootstrap.extend(tomcat.install_and_configure(node,
                     tomcat_config, self._install_local_wars))
-                responses.append(compute.submitScriptOnNode(node.getId(),
-                    StatementList(bootstrap), RunScriptOptions.NONE))
-
-            log.info("Waiting until all nodes are configured...")
-            for i, future in enumerate(responses):
-                result = future.get()
-                log.info("%s node at %s -> %s" % (nodes[i].getName(),
-                    Iterables.getOnlyElement(nodes[i].getPublicAddresses()),
-                    "OK" if result.getExitStatus() == 0 else "FAILED"))
+                return bootstrap
+
+            provisioner = NodeProvisioner(self._context, template,
+                self.__config.getint("deploy-api", "template_cores"),
+                self.__config.getint("deploy-api", "template_ram"),
+                self._login_credentials("deploy-api"), "kahuna-api",
+                options.parallelism)
+            self._print_node_results(
+                provisioner.provision(options.count, configure))
             log.info("Done!")
 
         except (AbiquoException, AuthorizationException), ex:
             print "Error: %s" % ex.getMessage()
-        except RunNodesException, ex:
-            self._print_node_errors(ex)
 
     def deploy_rs(self, args):
         """ Deploys and configures custom Abiquo Remote Services """
@@ -218,6 +208,9 @@ class ScalabilityPlugin(AbsPlugin):
         parser.add_option('-c', '--count', type="int", default=1,
                 help='Number of nodes to deploy (default 1)',
                 action='store', dest='count')
+        parser.add_option('-P', '--parallelism', type="int", default=5,
+                help='Number of nodes to provision concurrently (default 5)',
+                action='store', dest='parallelism')
         parser.add_option('-s', '--hypervisor-sessions', type="int", default=2,
                 help='Number of concurrent hypervisor sessions (default 2)',
                 action='store', dest='hypervisorsessions')
@@ -259,19 +252,7 @@ class ScalabilityPlugin(AbsPlugin):
             log.info("Deploying %s %s nodes to %s..." % (options.count,
                 template.getImage().getName(), vdc.getDescription()))
 
-            # Due to the IpPoolManagement concurrency issue, we need to deploy
-            # the nodes one by one
-            nodes = []
-            responses = []
-            for i in xrange(options.count):
-                node = Iterables.getOnlyElement(
-                    compute.createNodesInGroup("kahuna-rs", 1, template))
-                log.info("Created node %s at %s" % (node.getName(),
-                    Iterables.getOnlyElement(node.getPublicAddresses())))
-                nodes.append(node)
-
-                log.info("Cooking %s with Chef in the background..." %
-                    node.getName())
+            def configure(i, node):
                 tomcat_config = {
                     "rabbit": options.rabbit,
                     "datacenter": options.dc if options.dc else node.getName(),
@@ -283,23 +264,20 @@ class ScalabilityPlugin(AbsPlugin):
                 install_tomcat = tomcat.install_and_configure(node,
                     tomcat_config, self._install_jenkins_wars(options.jenkins,
                         options.wars))
-                bootstrap = hostname.configure(node) + \
+                return hostname.configure(node) + \
                     [ntp.install()] + redis.install("2.6.4") + install_tomcat
-                responses.append(compute.submitScriptOnNode(node.getId(),
-                    StatementList(bootstrap), RunScriptOptions.NONE))
-
-            log.info("Waiting until all nodes are configured...")
-            for i, future in enumerate(responses):
-                result = future.get()
-                log.info("%s node at %s -> %s" % (nodes[i].getName(),
-                    Iterables.getOnlyElement(nodes[i].getPublicAddresses()),
-                    "OK" if result.getExitStatus() == 0 else "FAILED"))
+
+            provisioner = NodeProvisioner(self._context, template,
+                self.__config.getint("deploy-rs", "template_cores"),
+                self.__config.getint("deploy-rs", "template_ram"),
+                self._login_credentials("deploy-rs"), "kahuna-rs",
+                options.parallelism)
+            self._print_node_results(
+                provisioner.provision(options.count, configure))
             log.info("Done!")
 
         except (AbiquoException, AuthorizationException), ex:
             print "Error: %s" % ex.getMessage()
-        except RunNodesException, ex:
-            self._print_node_errors(ex)
 
     def _template_options(self, compute, deploycommand):
         locations = compute.listAssignableLocations()
@@ -307,14 +285,17 @@ class ScalabilityPlugin(AbsPlugin):
         location = filter(lambda l: l.getDescription() == vdc, locations)[0]
         log.debug("Found VDC %s %s" % (location.getId(),
             location.getDescription()))
-        login = LoginCredentials.builder() \
+        return (location, compute.templateOptions()
+            .overrideLoginCredentials(self._login_credentials(deploycommand)))
+
+    def _login_credentials(self, deploycommand):
+        """ Returns the credentials to access the deployed nodes """
+        return LoginCredentials.builder() \
             .authenticateSudo(self.__config.getboolean(deploycommand,
                     "requires_sudo")) \
             .user(self.__config.get(deploycommand, "template_user")) \
             .password(self.__config.get(deploycommand, "template_pass")) \
             .build()
-        return (location, compute.templateOptions()
-            .overrideLoginCredentials(login))
 
     def _install_local_wars(self):
         """ Copies uploaded wars in the tomcat webapps directory """
@@ -341,6 +322,16 @@ class ScalabilityPlugin(AbsPlugin):
             return script
         return jenkins_download
 
+    def _print_node_results(self, results):
+        """ Prints the result of each node as soon as it is provisioned """
+        for i, node, status, error in results:
+            if error:
+                log.info("Node %s -> FAILED (%s)" % (i, error))
+            else:
+                log.info("%s node at %s -> %s" % (node.getName(),
+                    Iterables.getOnlyElement(node.getPublicAddresses()),
+                    "OK" if status == 0 else "FAILED"))
+
     def _print_node_errors(self, ex):
         for error in ex.getExecutionErrors().values():
             print "Error %s" % error.getMessage()
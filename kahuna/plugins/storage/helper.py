@@ -1,22 +1,15 @@
 #!/usr/bin/env jython
 
 import logging
-from org.jclouds.abiquo.predicates.cloud import VirtualMachinePredicates
-from org.jclouds.abiquo.predicates.cloud import VirtualDiskPredicates
+from kahuna.inventory import inventory
 
 log = logging.getLogger('kahuna')
 
 
 def find_volume(context, name):
     """ Find a volume given its name """
-    cloud = context.getCloudService()
-    vdcs = cloud.listVirtualDatacenters()
     log.debug("Looking for volume: %s" % name)
-    for vdc in vdcs:
-        volume = vdc.findVolume(VirtualDiskPredicates.name(name))
-        if volume:
-            log.debug("Found volume in virtual datacenter: %s" % vdc.getName())
-            return volume
+    return inventory(context).find("volume", name)
 
 
 def refresh_volume(context, volume):
@@ -25,12 +18,15 @@ def refresh_volume(context, volume):
     return vdc.getVolume(volume.getId())
 
 
+def refresh_volumes(context, vdc, volumes):
+    """ Refresh the given volumes of the given virtual datacenter """
+    ids = [volume.getId() for volume in volumes]
+    return [volume for volume in vdc.listVolumes() if volume.getId() in ids]
+
+
 def get_attached_vm(context, volume):
     """ Get the virtual machine where the volume is attached """
     # TODO: Add parent navigation in jclouds.abiquo
     link = volume.unwrap().searchLink("virtualmachine")
     if link:
-        name = link.getTitle()
-        cloud = context.getCloudService()
-        return cloud.findVirtualMachine(
-                VirtualMachinePredicates.internalName(name))
+        return inventory(context).find("vm", link.getTitle())
@@ -3,10 +3,32 @@
 # Plugin adapted from: https://gist.github.com/2586413
 # Original author: Enric Ruiz
 
+from __future__ import with_statement
 from kahuna.abstract import AbsPlugin
+from kahuna.utils.output import Output
+from kahuna.utils.prettyprint import pprint_job_stats
+from kahuna.utils.prettyprint import pprint_stuck_tasks
+from kahuna.utils.prettyprint import PTable
 from kahuna.utils.prettyprint import pprint_tasks
 from optparse import OptionParser
+import math
 import redis
+import sys
+import time
+
+# The list with the tasks of each virtual machine
+OWNER_PREFIX = "Owner:VirtualMachine:"
+
+# The states of the tasks that are no longer running
+FINISHED_STATES = ["FINISHED_SUCCESSFULLY", "FINISHED_UNSUCCESSFULLY",
+        "ABORTED"]
+
+# Seconds of each duration unit
+DURATION_UNITS = {"s": 1, "m": 60, "h": 3600, "d": 86400}
+
+# The fields of each exported task and job
+EXPORT_FIELDS = ["kind", "vm", "task", "id", "type", "state",
+        "rollbackState", "timestamp", "duration"]
 
 
 class TarantinoPlugin(AbsPlugin):
@@ -16,6 +38,9 @@ class TarantinoPlugin(AbsPlugin):
         """ Get teh lsit of commands of the plugin """
         commands = {}
         commands['vm-tasks'] = self.vm_tasks
+        commands['stuck'] = self.stuck
+        commands['stats'] = self.stats
+        commands['watch'] = self.watch
         return commands
 
     def _load_context(self):
@@ -27,7 +52,10 @@ class TarantinoPlugin(AbsPlugin):
         parser = OptionParser(usage="tarantino dump <options>",
                 add_help_option=False)
         parser.add_option("-v", "--vm", dest="vm",
-                 help="The id of the virtual machine to check")
+                 help=("The id of the virtual machine to check, or a comma "
+                 "separated list of ids"))
+        parser.add_option("--all-vms", dest="all_vms", action="store_true",
+                help="Check all virtual machines with tasks")
         parser.add_option("-h", "--host", dest="host", default="localhost",
                 help="The Redis host (default: localhost)")
         parser.add_option("-p", "--port", dest="port", type="int",
@@ -37,21 +65,389 @@ class TarantinoPlugin(AbsPlugin):
                 help="Show all tasks")
 
         (options, args) = parser.parse_args(args)
-        if not options.vm:
+        if not options.vm and not options.all_vms:
             parser.print_help()
             return
 
         r = redis.Redis(options.host, options.port)
-        range = -1 if options.all else 0
-        task_keys = r.lrange("Owner:VirtualMachine:%s" % options.vm, 0, range)
-
-        tasks = []
-        for task_key in task_keys:
-            task = r.hgetall(task_key)
-            job_keys = r.lrange(task['jobs'], 0, -1)
-            jobs = map(lambda k: r.hgetall(k), job_keys)
-            tasks.append((task, jobs))
-        pprint_tasks(tasks)
+        if options.all_vms:
+            batches = scan(r, OWNER_PREFIX + "*")
+        else:
+            batches = [[OWNER_PREFIX + vm.strip()
+                for vm in options.vm.split(",") if vm.strip()]]
+        end = -1 if options.all else 0
+
+        for owners in batches:
+            all_tasks = fetch_tasks(r, owners, end)
+            for owner, tasks in zip(owners, all_tasks):
+                if options.all_vms or len(owners) > 1:
+                    print "Virtual machine %s:" % owner[len(OWNER_PREFIX):]
+                pprint_tasks(tasks)
+                if options.all_vms or len(owners) > 1:
+                    print
+
+    def stuck(self, args):
+        """ Finds the tasks that are still running """
+        parser = OptionParser(usage="tarantino stuck <options>",
+                add_help_option=False)
+        parser.add_option("-o", "--older-than", dest="older_than",
+                help=("Show only the tasks started before this time ago, "
+                "such as 30s, 10m, 2h or 1d (default: show all)"))
+        parser.add_option("-b", "--batch", dest="batch", type="int",
+                default=100, help=("The number of virtual machines to check "
+                "in each request (default: 100)"))
+        parser.add_option("-h", "--host", dest="host", default="localhost",
+                help="The Redis host (default: localhost)")
+        parser.add_option("-p", "--port", dest="port", type="int",
+                default=6379, help="The Redis port (default: 6379)")
+        (options, args) = parser.parse_args(args)
+
+        try:
+            older_than = parse_duration(options.older_than or "0")
+        except ValueError, ex:
+            print "Error: %s" % ex
+            return
+
+        r = redis.Redis(options.host, options.port)
+        deadline = time.time() - older_than
+
+        def is_stuck(task):
+            return task['state'] not in FINISHED_STATES and \
+                    long(task['timestamp']) <= deadline
+
+        def find_stuck():
+            for owners in scan(r, OWNER_PREFIX + "*", options.batch):
+                all_tasks = fetch_tasks(r, owners, select=is_stuck)
+                for owner, tasks in zip(owners, all_tasks):
+                    for task, jobs in tasks:
+                        yield (owner[len(OWNER_PREFIX):], task, jobs)
+
+        return pprint_stuck_tasks(find_stuck())
+
+    def stats(self, args):
+        """ Exports all tasks and shows the latency of each job type """
+        parser = OptionParser(usage="tarantino stats <options>",
+                add_help_option=False)
+        parser.add_option("-f", "--file", dest="file",
+                default="tarantino-tasks.ndjson.gz",
+                help=("The file where the tasks and jobs are exported "
+                "(default: tarantino-tasks.ndjson.gz)"))
+        parser.add_option("-b", "--batch", dest="batch", type="int",
+                default=100, help=("The number of virtual machines to read "
+                "in each request (default: 100)"))
+        parser.add_option("-h", "--host", dest="host", default="localhost",
+                help="The Redis host (default: localhost)")
+        parser.add_option("-p", "--port", dest="port", type="int",
+                default=6379, help="The Redis port (default: 6379)")
+        (options, args) = parser.parse_args(args)
+
+        r = redis.Redis(options.host, options.port)
+        stats = JobStats()
+        with Output("ndjson", options.file) as output:
+            writer = output.writer(EXPORT_FIELDS)
+            for owners in scan(r, OWNER_PREFIX + "*", options.batch):
+                all_tasks = fetch_tasks(r, owners)
+                for owner, tasks in zip(owners, all_tasks):
+                    vm = owner[len(OWNER_PREFIX):]
+                    for task, jobs in tasks:
+                        for record in export_records(vm, task, jobs):
+                            writer.add(record)
+                            if record[0] == "job":
+                                stats.add(record[4], record[5], record[7],
+                                        record[8])
+            writer.pprint()
+
+        print "Tasks exported to: %s" % options.file
+        pprint_job_stats(stats.summary())
+
+    def watch(self, args):
+        """ Prints the state changes of the tasks as they happen """
+        parser = OptionParser(usage="tarantino watch <options>",
+                add_help_option=False)
+        parser.add_option("-v", "--vm", dest="vm",
+                 help=("Watch only the tasks of this virtual machine, or of "
+                 "a comma separated list of them"))
+        parser.add_option("-t", "--type", dest="type",
+                help="Watch only the jobs of this type")
+        parser.add_option("-k", "--keys", dest="keys", default="*",
+                help=("The pattern of the keys to watch. Use it if "
+                "Tarantino shares Redis with other applications "
+                "(default: *)"))
+        parser.add_option("-d", "--db", dest="db", type="int", default=0,
+                help="The Redis database (default: 0)")
+        parser.add_option("-h", "--host", dest="host", default="localhost",
+                help="The Redis host (default: localhost)")
+        parser.add_option("-p", "--port", dest="port", type="int",
+                default=6379, help="The Redis port (default: 6379)")
+        (options, args) = parser.parse_args(args)
+
+        r = redis.Redis(options.host, options.port, options.db)
+        try:
+            events = r.config_get("notify-keyspace-events")
+            if not events.get("notify-keyspace-events"):
+                print ("Keyspace notifications are disabled. Enable them "
+                    "with: redis-cli config set notify-keyspace-events Kgxhl")
+                return 1
+        except redis.ResponseError:
+            # CONFIG may be disabled. Assume notifications are enabled
+            pass
+
+        vms = options.vm and [vm.strip() for vm in options.vm.split(",")
+                if vm.strip()] or None
+        watcher = TaskWatcher(r, vms, options.type)
+        pubsub = r.pubsub()
+        pubsub.psubscribe("__keyspace@%s__:%s" % (options.db, options.keys))
+        print "Watching tasks. Press Ctrl+C to stop..."
+        table = PTable(["time", "vm", "task/job", "id", "type", "state"],
+                [8, 8, 8, 36, 24, 50])
+        try:
+            for message in pubsub.listen():
+                if message['type'] != 'pmessage':
+                    continue
+                key = message['channel'].split(":", 1)[1]
+                for row in watcher.event(key, message['data']):
+                    table.add(row)
+                    sys.stdout.flush()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            pubsub.reset()
+
+
+def scan(r, pattern, count=100):
+    """ Yields batches with the keys matching the given pattern.
+
+    The keyspace is walked incrementally with SCAN, so Redis is never
+    blocked and only one batch is kept in memory.
+    """
+    cursor = "0"
+    while True:
+        cursor, keys = r.execute_command("SCAN", cursor, "MATCH", pattern,
+                "COUNT", count)
+        if keys:
+            yield keys
+        if str(cursor) == "0":
+            break
+
+
+class TaskWatcher:
+    """ Tracks the state of the tasks and jobs from keyspace events.
+
+    Only the hashes that receive an event are read, once per event, so
+    it does not poll Redis. The virtual machine of each task and job is
+    learned from the owner lists and the job lists, and the ones already
+    in the given virtual machines are loaded when starting.
+    """
+
+    def __init__(self, r, vms=None, job_type=None):
+        """ Initializes the watcher, loading the tasks of the given vms """
+        self.__redis = r
+        self.__vms = vms
+        self.__job_type = job_type
+        self.__states = {}      # Last known state of each task and job
+        self.__owners = {}      # The virtual machine of each task and job
+        self.__job_lists = {}   # The virtual machine of each job list
+        if vms:
+            self.__load(vms)
+
+    def event(self, key, event):
+        """ Processes a keyspace event and returns the rows to print """
+        if event in ("del", "expired", "evicted"):
+            self.__states.pop(key, None)
+            self.__owners.pop(key, None)
+            self.__job_lists.pop(key, None)
+            return []
+        if key.startswith(OWNER_PREFIX) and event in ("lpush", "rpush"):
+            vm = key[len(OWNER_PREFIX):]
+            if self.__vms and vm not in self.__vms:
+                return []
+            # New tasks are pushed to the head of the owner list
+            task_key = self.__redis.lindex(key, 0)
+            if task_key and task_key not in self.__owners:
+                self.__owners[task_key] = vm
+                return self.__changed(task_key)
+            return []
+        if key in self.__job_lists and event in ("lpush", "rpush"):
+            vm = self.__job_lists[key]
+            for job_key in self.__redis.lrange(key, 0, -1):
+                self.__owners.setdefault(job_key, vm)
+            return []
+        if event == "hset":
+            if self.__vms and key not in self.__owners:
+                return []
+            return self.__changed(key)
+        return []
+
+    def __changed(self, key):
+        """ Reads a task or job and returns its state change, if any """
+        entity = self.__redis.hgetall(key)
+        state = entity.get('state')
+        if not state or state == self.__states.get(key):
+            return []
+        previous = self.__states.get(key, "new")
+        self.__states[key] = state
+        vm = self.__owners.get(key, "-")
+        if 'taskId' in entity:
+            if 'jobs' in entity:
+                self.__job_lists[entity['jobs']] = vm
+            if self.__job_type:
+                return []
+            return [[time.strftime("%H:%M:%S"), vm, "task",
+                entity['taskId'], entity.get('type'),
+                "%s -> %s" % (previous, state)]]
+        if self.__job_type and entity.get('type') != self.__job_type:
+            return []
+        return [[time.strftime("%H:%M:%S"), vm, "job", entity.get('id'),
+            entity.get('type'), "%s -> %s" % (previous, state)]]
+
+    def __load(self, vms):
+        """ Loads the known tasks and jobs of the given virtual machines """
+        pipe = self.__redis.pipeline(transaction=False)
+        [pipe.lrange(OWNER_PREFIX + vm, 0, -1) for vm in vms]
+        task_keys = []
+        for vm, keys in zip(vms, pipe.execute()):
+            for key in keys:
+                self.__owners[key] = vm
+                task_keys.append(key)
+
+        [pipe.hgetall(key) for key in task_keys]
+        job_lists = []
+        for key, task in zip(task_keys, pipe.execute()):
+            if 'jobs' in task:
+                self.__states[key] = task.get('state')
+                self.__job_lists[task['jobs']] = self.__owners[key]
+                job_lists.append(task['jobs'])
+
+        [pipe.lrange(key, 0, -1) for key in job_lists]
+        job_keys = []
+        for job_list, keys in zip(job_lists, pipe.execute()):
+            for key in keys:
+                self.__owners[key] = self.__job_lists[job_list]
+                job_keys.append(key)
+
+        [pipe.hget(key, 'state') for key in job_keys]
+        for key, state in zip(job_keys, pipe.execute()):
+            self.__states[key] = state
+
+
+def export_records(vm, task, jobs):
+    """ Returns the export records of a task and its jobs.
+
+    Tarantino only stores when each task was created and when each job
+    was last updated, so the duration of a job is the time since the
+    previous job (or the task creation) was updated. Jobs that have not
+    been run yet have no duration.
+    """
+    created = long(task['timestamp'])
+    previous = created
+    records = []
+    for job in jobs:
+        timestamp = long(job['timestamp'])
+        duration = None
+        if job['state'] not in ("PENDING", "QUEUEING") \
+                and timestamp >= previous:
+            duration = timestamp - previous
+            previous = timestamp
+        records.append(["job", vm, task['taskId'], job['id'], job['type'],
+            job['state'], job['rollbackState'], timestamp, duration])
+    records.insert(0, ["task", vm, task['taskId'], task['taskId'],
+        task['type'], task['state'], None, created, previous - created])
+    return records
+
+
+class JobStats:
+    """ Durations, throughput and failures of each job type """
+
+    def __init__(self):
+        self.__durations = {}
+        self.__counts = {}
+        self.__failures = {}
+        self.__first = None
+        self.__last = None
+
+    def add(self, type, state, timestamp, duration):
+        """ Accounts a job """
+        self.__counts[type] = self.__counts.get(type, 0) + 1
+        if "FAIL" in state or state == "ABORTED":
+            self.__failures[type] = self.__failures.get(type, 0) + 1
+        if duration is not None:
+            self.__durations.setdefault(type, []).append(duration)
+        self.__first = min(self.__first or timestamp, timestamp)
+        self.__last = max(self.__last, timestamp)
+
+    def summary(self):
+        """ Returns a (type, count, failure rate, p50, p90, p99, max,
+        jobs per minute) tuple per job type, slowest types first """
+        minutes = max((self.__last or 0) - (self.__first or 0), 60) / 60.0
+        summary = []
+        for type, count in self.__counts.items():
+            durations = sorted(self.__durations.get(type, []))
+            summary.append((type, count,
+                float(self.__failures.get(type, 0)) / count,
+                percentile(durations, 50), percentile(durations, 90),
+                percentile(durations, 99),
+                durations and durations[-1] or None, count / minutes))
+        summary.sort(key=lambda row: row[5] or 0, reverse=True)
+        return summary
+
+
+def percentile(values, percent):
+    """ Returns the given percentile of the sorted values """
+    if not values:
+        return None
+    rank = int(math.ceil(percent / 100.0 * len(values))) - 1
+    return values[max(0, min(rank, len(values) - 1))]
+
+
+def parse_duration(text):
+    """ Parses a duration such as 10m into seconds """
+    text = text.strip()
+    unit = DURATION_UNITS.get(text[-1:], None)
+    number = text[:-1] if unit else text
+    if not number.isdigit():
+        raise ValueError("Invalid duration: %s" % text)
+    return int(number) * (unit or 1)
+
+
+def fetch_tasks(r, owners, end=-1, select=None):
+    """ Fetches the tasks of the given owners and their jobs.
+
+    Returns a list with the (task, jobs) tuples of each owner. Keys are
+    read level by level (all task lists, then all tasks, then all job
+    lists and then all jobs) in a single pipeline per level, so it takes
+    four round trips no matter how many tasks there are. If a select
+    function is given, only the tasks it accepts (and their jobs) are
+    returned.
+    """
+    pipe = r.pipeline(transaction=False)
+    [pipe.lrange(owner, 0, end) for owner in owners]
+    owner_task_keys = pipe.execute()
+
+    task_keys = [key for keys in owner_task_keys for key in keys]
+    [pipe.hgetall(key) for key in task_keys]
+    tasks = dict(zip(task_keys, pipe.execute()))
+    # Tasks may have expired after reading the list
+    tasks = dict([(key, task) for (key, task) in tasks.items()
+        if 'jobs' in task and (not select or select(task))])
+
+    job_lists = [task['jobs'] for task in tasks.values()]
+    [pipe.lrange(key, 0, -1) for key in job_lists]
+    job_keys = dict(zip(job_lists, pipe.execute()))
+
+    all_job_keys = [key for keys in job_keys.values() for key in keys]
+    [pipe.hgetall(key) for key in all_job_keys]
+    jobs = dict(zip(all_job_keys, pipe.execute()))
+
+    result = []
+    for keys in owner_task_keys:
+        owner_tasks = []
+        for key in keys:
+            task = tasks.get(key)
+            if task:
+                owner_tasks.append((task, [jobs[job]
+                    for job in job_keys[task['jobs']] if jobs[job]]))
+        result.append(owner_tasks)
+    return result
 
 
 def load():
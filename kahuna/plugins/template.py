@@ -1,6 +1,13 @@
 #!/usr/bin/env jython
 
+from __future__ import with_statement
+from optparse import OptionParser
 from kahuna.abstract import AbsPlugin
+from kahuna.sync import list_templates
+from kahuna.utils.output import Output
+from kahuna.utils.output import add_output_options
+from kahuna.utils.prettyprint import TEMPLATE_COLUMNS
+from kahuna.utils.prettyprint import parse_columns
 from kahuna.utils.prettyprint import pprint_templates
 from org.jclouds.abiquo.domain.exception import AbiquoException
 from org.jclouds.rest import AuthorizationException
@@ -11,11 +18,22 @@ class TemplatePlugin(AbsPlugin):
 
     def list(self, args):
         """ List all available templates """
+        parser = OptionParser(usage="template list <options>")
+        parser.add_option("--columns", dest="columns",
+                help=("Comma separated list of columns to show: %s" %
+                ",".join([column[0] for column in TEMPLATE_COLUMNS])))
+        add_output_options(parser)
+        (options, args) = parser.parse_args(args)
         try:
-            admin = self._context.getAdministrationService()
-            enterprise = admin.getCurrentEnterprise()
-            templates = enterprise.listTemplates()
-            pprint_templates(templates)
+            columns = parse_columns(options.columns, TEMPLATE_COLUMNS)
+        except ValueError, ex:
+            print "Error: %s" % ex
+            return
+
+        try:
+            templates = list_templates(self._context)
+            with Output(options.output, options.output_file) as output:
+                pprint_templates(templates, columns, output)
         except (AbiquoException, AuthorizationException), ex:
             print "Error: %s" % ex.getMessage()
 
@@ -2,6 +2,7 @@
 
 from optparse import OptionParser
 from kahuna.abstract import AbsPlugin
+from kahuna.sync import list_virtual_datacenters
 from kahuna.utils.prettyprint import pprint_tiers
 from kahuna.utils.prettyprint import pprint_vdcs
 from org.jclouds.abiquo.predicates.cloud import VirtualDatacenterPredicates
@@ -15,8 +16,7 @@ class VirtualDatacenterPlugin(AbsPlugin):
     def list(self, args):
         """ List all available virtual datacenters """
         try:
-            cloud = self._context.getCloudService()
-            vdcs = cloud.listVirtualDatacenters()
+            vdcs = list_virtual_datacenters(self._context)
             pprint_vdcs(vdcs)
         except (AbiquoException, AuthorizationException), ex:
             print "Error: %s" % ex.getMessage()
@@ -1,40 +1,67 @@
 #!/usr/bin/env jython
 
+import jarray
 import logging
-from com.abiquo.model.enumerator import ConversionState
+from fnmatch import fnmatch
+from java.lang import Throwable
+from kahuna.inventory import inventory
+from kahuna.utils.parallel import imap
+from com.abiquo.server.core.cloud import VirtualMachineState
+from org.jclouds.abiquo.domain.cloud import VirtualMachine
+from org.jclouds.abiquo.predicates.cloud import VirtualAppliancePredicates
 from org.jclouds.abiquo.predicates.cloud import VirtualDatacenterPredicates
-from org.jclouds.abiquo.predicates.cloud \
-        import VirtualMachineTemplatePredicates
 
 log = logging.getLogger('kahuna')
 
 
 def find_template_by_id(context, id):
     """ Find a template given its id """
-    admin = context.getAdministrationService()
-    enterprise = admin.getCurrentEnterprise()
-    return enterprise.findTemplate(VirtualMachineTemplatePredicates.id(id))
+    return inventory(context).get("template", id)
 
 
-def find_compatible_virtual_datacenters(context, template):
-    """ Find a virtual datacenter compatible with the template. """
-    cloud = context.getCloudService()
-    all = cloud.listVirtualDatacenters(
-            VirtualDatacenterPredicates.datacenter(template.getDatacenter()))
+def find_compatible_virtual_datacenter(context, template):
+    """ Find a virtual datacenter compatible with the template.
+
+    The compatibility of the templates is cached in the inventory, so it
+    does not need to be checked against each virtual datacenter.
+    """
+    for vdc in inventory(context).find_compatible_vdcs(template.getId()):
+        log.debug("%s compatible with %s" % (vdc.getName(),
+            template.getName()))
+        return vdc
+    return None
 
-    def compatible(vdc):
-        type = vdc.getHypervisorType()
-        res = type.isCompatible(template.getDiskFormatType())
-        log.debug("%s compatible with source format: %s" %
-            (vdc.getName(), res))
-        if not res:
-            conv = template.listConversions(type, ConversionState.FINISHED)
-            res = len(conv) > 0
-            log.debug("%s compatible with conversions: %s" %
-                (vdc.getName(), res))
-        return res
 
-    return filter(compatible, all)
+def find_vms(context, match=None, vapp=None, vdc=None, names=None):
+    """ Find the virtual machines matching all the given criteria.
+
+    The match is a shell-style pattern for the name of the virtual
+    machine, vapp and vdc are the names of the virtual appliance and
+    virtual datacenter where they are, and names a list of names.
+    """
+    cloud = context.getCloudService()
+    if vapp or vdc:
+        if vdc:
+            vdcs = cloud.listVirtualDatacenters(
+                    VirtualDatacenterPredicates.name(vdc))
+        else:
+            vdcs = cloud.listVirtualDatacenters()
+        vms = []
+        for virtual_datacenter in vdcs:
+            if vapp:
+                vapps = virtual_datacenter.listVirtualAppliances(
+                        VirtualAppliancePredicates.name(vapp))
+            else:
+                vapps = virtual_datacenter.listVirtualAppliances()
+            [vms.extend(v.listVirtualMachines()) for v in vapps]
+    else:
+        vms = cloud.listVirtualMachines()
+    if match:
+        vms = [vm for vm in vms if fnmatch(vm.getInternalName(), match)
+                or fnmatch(vm.getNameLabel() or "", match)]
+    if names:
+        vms = [vm for vm in vms if vm.getInternalName() in names]
+    return vms
 
 
 def refresh_vm(context, vm):
@@ -53,6 +80,27 @@ def deploy_vm(context, vm):
     return refresh_vm(context, vm)
 
 
+def deploy_vapp(context, vapp, vms):
+    """ Deploy the given virtual appliance and its new virtual machines.
+
+    The whole virtual appliance is deployed at once and awaited with a
+    single monitor. Returns a list of (vm, result) tuples with the given
+    virtual machines, refreshed.
+    """
+    monitor = context.getMonitoringService().getVirtualApplianceMonitor()
+    print ("Deploying virtual appliance %s with %s new virtual machines... "
+        "This may take some time.") % (vapp.getName(), len(vms))
+    vapp.deploy()
+    monitor.awaitCompletionDeploy(vapp)
+    deployed = dict([(vm.getId(), vm) for vm in vapp.listVirtualMachines()])
+    results = []
+    for vm in vms:
+        vm = deployed.get(vm.getId(), vm)
+        results.append((vm,
+            "OK" if vm.getState() == VirtualMachineState.ON else "FAILED"))
+    return results
+
+
 def undeploy_vm(context, vm):
     """ Undeploy the given virtual machine """
     monitor = context.getMonitoringService().getVirtualMachineMonitor()
@@ -71,3 +119,68 @@ def change_state_vm(context, vm, new_state):
     vm.changeState(new_state)
     monitor.awaitState(new_state, vm)
     return vm
+
+
+def deploy_vms(context, vms, concurrency):
+    """ Deploy the given virtual machines, concurrency at a time """
+    monitor = context.getMonitoringService().getVirtualMachineMonitor()
+    print "Deploying %s virtual machines... This may take some time." \
+            % len(vms)
+    return _bulk_operation(context, vms, concurrency,
+            lambda vm: vm.deploy(),
+            lambda vms: monitor.awaitCompletionDeploy(_array(vms)),
+            VirtualMachineState.ON)
+
+
+def undeploy_vms(context, vms, concurrency):
+    """ Undeploy the given virtual machines, concurrency at a time """
+    monitor = context.getMonitoringService().getVirtualMachineMonitor()
+    print "Undeploying %s virtual machines... This may take some time." \
+            % len(vms)
+    return _bulk_operation(context, vms, concurrency,
+            lambda vm: vm.undeploy(),
+            lambda vms: monitor.awaitCompletionUndeploy(_array(vms)),
+            VirtualMachineState.NOT_ALLOCATED)
+
+
+def change_state_vms(context, vms, new_state, concurrency):
+    """ Change the state of the given virtual machines """
+    monitor = context.getMonitoringService().getVirtualMachineMonitor()
+    print("Changing state of %s virtual machines to %s... "
+        "This may take some time." % (len(vms), new_state.name()))
+    return _bulk_operation(context, vms, concurrency,
+            lambda vm: vm.changeState(new_state),
+            lambda vms: monitor.awaitState(new_state, _array(vms)),
+            new_state)
+
+
+def _bulk_operation(context, vms, concurrency, start, wait, expected):
+    """ Runs an asynchronous operation on several virtual machines.
+
+    The operation is started on all the virtual machines, sending up to
+    concurrency requests at a time, and then all of them are awaited
+    together with a single monitor. Returns a list of (vm, result)
+    tuples with the refreshed virtual machines, in the given order.
+    """
+    results = {}
+    started = []
+    for vm, result, error in imap(start, vms, concurrency):
+        if error:
+            message = error.getMessage() if isinstance(error, Throwable) \
+                    else str(error)
+            results[vm.getId()] = (vm, "FAILED (%s)" %
+                    (message or "").replace("\n", ""))
+        else:
+            started.append(vm)
+    if started:
+        wait(started)
+    for vm in started:
+        vm = refresh_vm(context, vm)
+        results[vm.getId()] = (vm,
+            "OK" if vm.getState() == expected else "FAILED")
+    return [results[vm.getId()] for vm in vms]
+
+
+def _array(vms):
+    """ Converts a list of virtual machines to a Java array """
+    return jarray.array(vms, VirtualMachine)
@@ -1,15 +1,32 @@
 #!/usr/bin/env jython
 
+from __future__ import with_statement
 import logging
+import os
 from optparse import OptionParser
 from kahuna.abstract import AbsPlugin
+from kahuna.inventory import inventory
+from kahuna.sync import list_templates
+from kahuna.sync import list_virtual_appliances
+from kahuna.sync import list_virtual_datacenters
+from kahuna.sync import list_virtual_machines
+from kahuna.utils.links import LinkCache
+from kahuna.utils.output import Output
+from kahuna.utils.output import add_output_options
+from kahuna.utils.parallel import imap
+from kahuna.utils.prettyprint import STREAM_SAMPLE
+from kahuna.utils.prettyprint import VM_COLUMNS
+from kahuna.utils.prettyprint import VM_DEFAULT_COLUMNS
+from kahuna.utils.prettyprint import page
+from kahuna.utils.prettyprint import parse_columns
+from kahuna.utils.prettyprint import pprint_vm_results
 from kahuna.utils.prettyprint import pprint_vms
 from virtualmachine import helper
 from com.abiquo.server.core.cloud import VirtualMachineState
+from java.util import UUID
 from org.jclouds.abiquo.domain.cloud import VirtualAppliance
 from org.jclouds.abiquo.domain.cloud import VirtualMachine
 from org.jclouds.abiquo.predicates.cloud import VirtualAppliancePredicates
-from org.jclouds.abiquo.predicates.cloud import VirtualMachinePredicates
 from org.jclouds.abiquo.domain.exception import AbiquoException
 from org.jclouds.rest import AuthorizationException
 
@@ -21,10 +38,44 @@ class VmPlugin(AbsPlugin):
 
     def list(self, args):
         """ List all virtual machines """
+        parser = OptionParser(usage="vm list <options>")
+        parser.add_option("-l", "--limit", dest="limit", type="int",
+                help="The maximum number of virtual machines to list")
+        parser.add_option("-o", "--offset", dest="offset", type="int",
+                default=0, help="The number of virtual machines to skip")
+        parser.add_option("--columns", dest="columns",
+                help=("Comma separated list of columns to show: %s" %
+                ",".join([column[0] for column in VM_COLUMNS])))
+        add_output_options(parser)
+        (options, args) = parser.parse_args(args)
         try:
-            cloud = self._context.getCloudService()
-            vms = cloud.listVirtualMachines()
-            pprint_vms(vms)
+            columns = parse_columns(options.columns, VM_COLUMNS)
+        except ValueError, ex:
+            print "Error: %s" % ex
+            return
+
+        try:
+            shown = columns or VM_DEFAULT_COLUMNS
+            links = LinkCache()
+            # The related entities shown are listed in advance, so their
+            # links are resolved without a request per virtual machine
+            vdcs = list_virtual_datacenters(self._context)
+            vapps = None
+            if "vdc" in shown:
+                links.prefetch(vdcs)
+            if "vapp" in shown:
+                vapps = list_virtual_appliances(self._context, vdcs)
+                links.prefetch(vapps)
+            if "template" in shown:
+                links.prefetch(list_templates(self._context))
+            if "enterprise" in shown:
+                links.prefetch([self._context.getAdministrationService()
+                    .getCurrentEnterprise()])
+            vms = list_virtual_machines(self._context, vdcs, vapps)
+            with Output(options.output, options.output_file) as output:
+                pprint_vms(page(vms, options.offset, options.limit),
+                        sample=STREAM_SAMPLE, links=links, columns=columns,
+                        output=output)
         except (AbiquoException, AuthorizationException), ex:
             print "Error: %s" % ex.getMessage()
 
@@ -39,32 +90,44 @@ class VmPlugin(AbsPlugin):
         parser.add_option("-v", "--verbose", dest="verbose",
                 action="store_true",
                 help="Show virtual machine extended information")
+        parser.add_option("--columns", dest="columns",
+                help=("Comma separated list of columns to show: %s" %
+                ",".join([column[0] for column in VM_COLUMNS])))
+        add_output_options(parser)
         (options, args) = parser.parse_args(args)
         name = options.name
         template = options.template
         if not name and not template:
             parser.print_help()
             return
+        try:
+            columns = parse_columns(options.columns, VM_COLUMNS)
+        except ValueError, ex:
+            print "Error: %s" % ex
+            return
 
         # Once user input has been read, find the virtual machine
         try:
-            cloud = self._context.getCloudService()
             if name:  # Find by name
-                vm = cloud.findVirtualMachine(
-                        VirtualMachinePredicates.internalName(name))
+                vm = inventory(self._context).find("vm", name)
                 if vm:
-                    pprint_vms([vm], options.verbose)
+                    with Output(options.output, options.output_file) \
+                            as output:
+                        pprint_vms([vm], options.verbose, columns=columns,
+                                output=output)
                 else:
                     print "No virtual machine found with name: %s" % name
             else:  # Find by template
-                vms = cloud.listVirtualMachines()
-                vmts = filter(lambda vm: template in
-                        vm.getTemplate().getName(), vms)
+                vmts = inventory(self._context).find_vms_by_template(
+                        template)
                 if len(vmts) == 0:
                     print ("No virtual machine found "
                         "matching template: %s" % template)
                 else:
-                    pprint_vms(vmts, options.verbose)
+                    with Output(options.output, options.output_file) \
+                            as output:
+                        pprint_vms(vmts, options.verbose, columns=columns,
+                                output=output)
 
         except (AbiquoException, AuthorizationException), ex:
             print "Error: %s" % ex.getMessage()
@@ -75,17 +138,22 @@ class VmPlugin(AbsPlugin):
         parser = OptionParser(usage="vm deploy <options>")
         parser.add_option("-n", "--name", dest="name",
                 help="The name of the virtual machine to deploy")
+        self._add_bulk_options(parser, "deploy")
         (options, args) = parser.parse_args(args)
         name = options.name
-        if not name:
+        if not name and not self._is_bulk(options):
             parser.print_help()
             return
 
         # Once user input has been read, find the VM
         try:
-            cloud = self._context.getCloudService()
-            vm = cloud.findVirtualMachine(
-                    VirtualMachinePredicates.internalName(name))
+            if not name:
+                vms = self._find_bulk_vms(options)
+                if vms:
+                    pprint_vm_results(helper.deploy_vms(self._context, vms,
+                        options.concurrency))
+                return
+            vm = inventory(self._context).find("vm", name)
             if vm:
                 vm = helper.deploy_vm(self._context, vm)
                 pprint_vms([vm])
@@ -100,17 +168,22 @@ class VmPlugin(AbsPlugin):
         parser = OptionParser(usage="vm undeploy <options>")
         parser.add_option("-n", "--name", dest="name",
                 help="The name of the virtual machine to undeploy")
+        self._add_bulk_options(parser, "undeploy")
         (options, args) = parser.parse_args(args)
         name = options.name
-        if not name:
+        if not name and not self._is_bulk(options):
             parser.print_help()
             return
 
         # Once user input has been read, find the virtual machine
         try:
-            cloud = self._context.getCloudService()
-            vm = cloud.findVirtualMachine(
-                    VirtualMachinePredicates.internalName(name))
+            if not name:
+                vms = self._find_bulk_vms(options)
+                if vms:
+                    pprint_vm_results(helper.undeploy_vms(self._context, vms,
+                        options.concurrency))
+                return
+            vm = inventory(self._context).find("vm", name)
             if vm:
                 vm = helper.undeploy_vm(self._context, vm)
                 pprint_vms([vm])
@@ -132,10 +205,24 @@ class VmPlugin(AbsPlugin):
         parser.add_option("-d", "--deploy", dest="deploy",
                 action="store_true",
                 help="Deploy the virtual machine after creating it")
+        parser.add_option("--count", dest="count", type="int", default=1,
+                help=("The number of virtual machines to create. If they "
+                "are deployed, they are created in a new virtual appliance "
+                "(default: 1)"))
+        parser.add_option("--name-prefix", dest="name_prefix",
+                help=("The name of the virtual machine. When creating "
+                "several ones, they are numbered after it"))
+        parser.add_option("--concurrency", dest="concurrency", type="int",
+                default=10, help=("The maximum number of virtual machines "
+                "to save at the same time (default: 10)"))
         (options, args) = parser.parse_args(args)
         if not options.template:
             parser.print_help()
             return
+        if options.count < 1 or options.concurrency < 1:
+            print "The count and the concurrency must be at least 1"
+            return 1
+        count = options.count
 
         try:
             api_context = self._context.getApiContext()
@@ -146,16 +233,20 @@ class VmPlugin(AbsPlugin):
                 return
             log.debug("Using template: %s" % template.getName())
 
-            vdcs = helper.find_compatible_virtual_datacenters(self._context,
+            vdc = helper.find_compatible_virtual_datacenter(self._context,
                     template)
-            if not vdcs:
+            if not vdc:
                 print ("Could not find a compatible virtual datacenter "
                     "for %s") % template.getName()
                 return
-            vdc = vdcs[0]
             log.debug("Using virtual datacenter: %s" % vdc.getName())
 
             name = "Kahuna-" + api_context.getIdentity()
+            if count > 1 and options.deploy:
+                # Each deployed batch gets its own virtual appliance, so
+                # deploying it does not touch the virtual machines created
+                # before, even by other batches started at the same time
+                name = "%s-%s" % (name, str(UUID.randomUUID())[:8])
             vapp = vdc.findVirtualAppliance(
                     VirtualAppliancePredicates.name(name))
             if not vapp:
@@ -165,19 +256,47 @@ class VmPlugin(AbsPlugin):
                         .name(name) \
                         .build()
                 vapp.save()
+                inventory(self._context).remember("vapp", vapp.getName(),
+                        vapp.getId(), (vdc.getId(), vapp.getId()))
 
-            builder = VirtualMachine.builder(api_context, vapp, template)
-            if options.cpu:
-                builder.cpu(options.cpu)
-            if options.ram:
-                builder.ram(options.ram)
-            vm = builder.build()
-            vm.save()
+            def create_vm(index):
+                builder = VirtualMachine.builder(api_context, vapp, template)
+                if options.cpu:
+                    builder.cpu(options.cpu)
+                if options.ram:
+                    builder.ram(options.ram)
+                if options.name_prefix:
+                    builder.nameLabel(options.name_prefix if count == 1
+                            else "%s-%s" % (options.name_prefix, index))
+                vm = builder.build()
+                vm.save()
+                inventory(self._context).remember("vm", vm.getInternalName(),
+                        vm.getId(), (vdc.getId(), vapp.getId(), vm.getId(),
+                            template.getName()))
+                return vm
 
-            if options.deploy:
-                vm = helper.deploy_vm(self._context, vm)
+            if count == 1:
+                vm = create_vm(1)
+                if options.deploy:
+                    vm = helper.deploy_vm(self._context, vm)
+                pprint_vms([vm])
+                return
 
-            pprint_vms([vm])
+            created = []
+            for index, vm, error in imap(create_vm, range(1, count + 1),
+                    options.concurrency):
+                if error:
+                    print "Could not create virtual machine %s: %s" % (
+                            index, error)
+                else:
+                    created.append((index, vm))
+            created.sort()
+            vms = [vm for index, vm in created]
+            if options.deploy and vms:
+                pprint_vm_results(helper.deploy_vapp(self._context, vapp,
+                    vms))
+            else:
+                pprint_vms(vms)
         except (AbiquoException, AuthorizationException), ex:
             print "Error: %s" % ex.getMessage()
 
@@ -197,9 +316,7 @@ class VmPlugin(AbsPlugin):
             return
 
         try:
-            cloud = self._context.getCloudService()
-            vm = cloud.findVirtualMachine(
-                    VirtualMachinePredicates.internalName(name))
+            vm = inventory(self._context).find("vm", name)
             if vm:
                 state = vm.getState()
                 if not options.undeploy and state.existsInHypervisor():
@@ -208,8 +325,10 @@ class VmPlugin(AbsPlugin):
                 elif options.undeploy and state.existsInHypervisor():
                     vm = helper.undeploy_vm(self._context, vm)
                     vm.delete()
+                    inventory(self._context).forget("vm", name)
                 else:
                     vm.delete()
+                    inventory(self._context).forget("vm", name)
             else:
                 print "No virtual machine found with name: %s" % name
         except (AbiquoException, AuthorizationException), ex:
@@ -232,16 +351,21 @@ class VmPlugin(AbsPlugin):
         parser = OptionParser(usage="vm %s <options>" % state_name)
         parser.add_option("-n", "--name", dest="name",
                 help="The name of the virtual machine to %s" % state_name)
+        self._add_bulk_options(parser, state_name)
         (options, args) = parser.parse_args(args)
         name = options.name
-        if not name:
+        if not name and not self._is_bulk(options):
             parser.print_help()
             return
 
         try:
-            cloud = self._context.getCloudService()
-            vm = cloud.findVirtualMachine(
-                    VirtualMachinePredicates.internalName(name))
+            if not name:
+                vms = self._find_bulk_vms(options)
+                if vms:
+                    pprint_vm_results(helper.change_state_vms(self._context,
+                        vms, new_state, options.concurrency))
+                return
+            vm = inventory(self._context).find("vm", name)
             if vm:
                 helper.change_state_vm(self._context, vm, new_state)
                 pprint_vms([vm])
@@ -250,6 +374,43 @@ class VmPlugin(AbsPlugin):
         except (AbiquoException, AuthorizationException), ex:
             print "Error: %s" % ex.getMessage()
 
+    def _add_bulk_options(self, parser, action):
+        """ Adds the options to select several virtual machines """
+        parser.add_option("-m", "--match", dest="match",
+                help=("A pattern (such as 'web-*') with the names of the "
+                "virtual machines to %s" % action))
+        parser.add_option("-a", "--vapp", dest="vapp",
+                help=("The name of the virtual appliance with the virtual "
+                "machines to %s" % action))
+        parser.add_option("-d", "--vdc", dest="vdc",
+                help=("The name of the virtual datacenter with the virtual "
+                "machines to %s" % action))
+        parser.add_option("-f", "--from-file", dest="file",
+                help=("A file with the names of the virtual machines "
+                "to %s, one per line" % action))
+        parser.add_option("-c", "--concurrency", dest="concurrency",
+                type="int", default=10,
+                help=("The maximum number of virtual machines to %s at "
+                "the same time (default: 10)" % action))
+
+    def _is_bulk(self, options):
+        """ Checks if the options select several virtual machines """
+        return options.match or options.vapp or options.vdc or options.file
+
+    def _find_bulk_vms(self, options):
+        """ Finds the virtual machines selected by the bulk options """
+        names = None
+        if options.file:
+            path = os.path.join(os.environ.get("KAHUNA_CWD", ""),
+                    options.file)
+            with open(path, "r") as f:
+                names = [line.strip() for line in f if line.strip()]
+        vms = helper.find_vms(self._context, options.match, options.vapp,
+                options.vdc, names)
+        if not vms:
+            print "No virtual machine found matching the given criteria"
+        return vms
+
 
 def load():
     """ Loads the current plugin """
@@ -1,11 +1,21 @@
 #!/usr/bin/env jython
 
+from __future__ import with_statement
 import logging
 from optparse import OptionParser
 from kahuna.abstract import AbsPlugin
+from kahuna.inventory import inventory
+from kahuna.sync import list_virtual_datacenters
+from kahuna.sync import list_volumes
+from kahuna.utils.links import LinkCache
+from kahuna.utils.output import Output
+from kahuna.utils.output import add_output_options
+from kahuna.utils.parallel import imap
+from kahuna.utils.prettyprint import STREAM_SAMPLE
+from kahuna.utils.prettyprint import VOLUME_COLUMNS
+from kahuna.utils.prettyprint import page
+from kahuna.utils.prettyprint import parse_columns
 from kahuna.utils.prettyprint import pprint_volumes
-from org.jclouds.abiquo.predicates.cloud import VirtualDiskPredicates
-from org.jclouds.abiquo.predicates.cloud import VirtualMachinePredicates
 from org.jclouds.abiquo.domain.cloud import Volume
 from org.jclouds.abiquo.domain.exception import AbiquoException
 from org.jclouds.rest import AuthorizationException
@@ -19,12 +29,33 @@ class VolumePlugin(AbsPlugin):
 
     def list(self, args):
         """ List all available volumes """
+        parser = OptionParser(usage="volume list <options>")
+        parser.add_option("-l", "--limit", dest="limit", type="int",
+                help="The maximum number of volumes to list")
+        parser.add_option("-o", "--offset", dest="offset", type="int",
+                default=0, help="The number of volumes to skip")
+        parser.add_option("--columns", dest="columns",
+                help=("Comma separated list of columns to show: %s" %
+                ",".join([column[0] for column in VOLUME_COLUMNS])))
+        add_output_options(parser)
+        (options, args) = parser.parse_args(args)
         try:
-            cloud = self._context.getCloudService()
-            vdcs = cloud.listVirtualDatacenters()
-            volumes = []
-            [volumes.extend(vdc.listVolumes()) for vdc in vdcs]
-            pprint_volumes(volumes)
+            columns = parse_columns(options.columns, VOLUME_COLUMNS)
+        except ValueError, ex:
+            print "Error: %s" % ex
+            return
+
+        try:
+            vdcs = list_virtual_datacenters(self._context)
+            volumes = list_volumes(self._context, vdcs)
+            links = LinkCache()
+            # The default columns include the virtual datacenter
+            if not columns or "vdc" in columns:
+                links.prefetch(vdcs)
+            with Output(options.output, options.output_file) as output:
+                pprint_volumes(page(volumes, options.offset, options.limit),
+                        sample=STREAM_SAMPLE, links=links, columns=columns,
+                        output=output)
         except (AbiquoException, AuthorizationException), ex:
             print "Error: %s" % ex.getMessage()
 
@@ -65,6 +96,8 @@ class VolumePlugin(AbsPlugin):
                 .sizeInMb(options.size) \
                 .build()
             volume.save()
+            inventory(self._context).remember("volume", volume.getName(),
+                    volume.getId(), (vdc.getId(), volume.getId()))
 
             pprint_volumes([volume])
         except (AbiquoException, AuthorizationException), ex:
@@ -81,93 +114,183 @@ class VolumePlugin(AbsPlugin):
             return
 
         try:
-            cloud = self._context.getCloudService()
-            vdcs = cloud.listVirtualDatacenters()
-            for vdc in vdcs:
-                volume = vdc.findVolume(
-                    VirtualDiskPredicates.name(options.name))
-                if volume:
-                    volume.delete()
-                    return
-
-            print "No volume found with name: %s" % options.name
+            volume = helper.find_volume(self._context, options.name)
+            if not volume:
+                print "No volume found with name: %s" % options.name
+                return
+            volume.delete()
+            inventory(self._context).forget("volume", options.name)
         except (AbiquoException, AuthorizationException), ex:
             print "Error: %s" % ex.getMessage()
 
     def attach(self, args):
-        """ Attach a volume to the given virtual machine """
+        """ Attach volumes to the given virtual machines """
         parser = OptionParser(usage="volume attach <options>")
         parser.add_option("-n", "--name", dest="name",
-                help="The name of the volume to attach")
+                help=("The names of the volumes to attach, separated by "
+                "commas"))
         parser.add_option("-v", "--vm", dest="vm",
                 help=("The name of the virtual machine "
-                "where the volume will be attached"))
+                "where the volumes will be attached"))
+        parser.add_option("--vms", dest="vms", action="append",
+                help=("A <vm>=<volume>,<volume>... pair with the volumes "
+                "to attach to a virtual machine. Can be used several "
+                "times to attach volumes to several virtual machines "
+                "at the same time"))
+        self._add_concurrency_option(parser)
         (options, args) = parser.parse_args(args)
-        if not options.name or not options.vm:
+        if options.vms:
+            try:
+                targets = [parse_target(vms) for vms in options.vms]
+            except ValueError, ex:
+                print "Error: %s" % ex
+                return
+        elif options.name and options.vm:
+            targets = [(options.vm, parse_names(options.name))]
+        else:
             parser.print_help()
             return
 
         try:
-            volume = helper.find_volume(self._context, options.name)
-            if not volume:
-                print "No volume found with name: %s" % options.name
-                return
-            cloud = self._context.getCloudService()
-            vm = cloud.findVirtualMachine(
-                    VirtualMachinePredicates.internalName(options.vm))
-            if not vm:
-                print "No virtual machine found with name: %s" % options.vm
-                return
+            # Attach all the volumes of each virtual machine at once, even
+            # if it is given several times or with different names
+            resolved = {}
+            for vm_name, names in targets:
+                vm = inventory(self._context).find("vm", vm_name)
+                if not vm:
+                    print "No virtual machine found with name: %s" % vm_name
+                    return 1
+                volumes = self._find_volumes(names)
+                if volumes is None:
+                    return 1
+                attached = resolved.setdefault(vm.getId(), (vm, []))[1]
+                ids = [volume.getId() for volume in attached]
+                attached.extend([volume for volume in volumes
+                    if volume.getId() not in ids])
 
-            log.debug("Attaching volume %s to %s..." % (options.name,
-                options.vm))
-            if vm.getState().existsInHypervisor():
-                print "Attaching volume to a running virtual machine.",
-                print "This may take some time..."
+            def attach(disks, volumes):
+                return disks + volumes
 
-            disks = list(vm.listVirtualDisks())
-            disks.append(volume)
-            vm.setVirtualDisks(disks)
-
-            pprint_volumes([helper.refresh_volume(self._context, volume)])
+            return self._reconfigure(resolved.values(), attach, "Attaching",
+                    options.concurrency)
         except (AbiquoException, AuthorizationException), ex:
             print "Error: %s" % ex.getMessage()
+            return 1
 
     def detach(self, args):
-        """ Detach a volume from the given virtual machine """
+        """ Detach volumes from the virtual machines they are attached to """
         parser = OptionParser(usage="volume detach <options>")
         parser.add_option("-n", "--name", dest="name",
-                help="The name of the volume to detach")
+                help=("The names of the volumes to detach, separated by "
+                "commas"))
+        self._add_concurrency_option(parser)
         (options, args) = parser.parse_args(args)
         if not options.name:
             parser.print_help()
             return
 
         try:
-            volume = helper.find_volume(self._context, options.name)
-            if not volume:
-                print "No volume found with name: %s" % options.name
-                return
+            volumes = self._find_volumes(parse_names(options.name))
+            if volumes is None:
+                return 1
 
-            vm = helper.get_attached_vm(self._context, volume)
-            if not vm:
-                print ("Volume %s is not attached "
-                        "to any virtual machine") % options.name
+            # Detach all the volumes of each virtual machine at once
+            targets = {}
+            for volume in volumes:
+                vm = helper.get_attached_vm(self._context, volume)
+                if not vm:
+                    print ("Volume %s is not attached "
+                            "to any virtual machine") % volume.getName()
+                    continue
+                targets.setdefault(vm.getId(), (vm, []))[1].append(volume)
+            if not targets:
                 return
 
-            log.debug("Detaching volume %s from %s..." % (options.name,
-                vm.getInternalName()))
-            if vm.getState().existsInHypervisor():
-                print "Detaching volume from a running virtual machine.",
-                print "This may take some time..."
-
-            disks = [disk for disk in vm.listVirtualDisks()
-                    if disk.getId() != volume.getId()]
-            vm.setVirtualDisks(disks)
+            def detach(disks, volumes):
+                ids = [volume.getId() for volume in volumes]
+                return [disk for disk in disks if disk.getId() not in ids]
 
-            pprint_volumes([helper.refresh_volume(self._context, volume)])
+            return self._reconfigure(targets.values(), detach, "Detaching",
+                    options.concurrency)
         except (AbiquoException, AuthorizationException), ex:
             print "Error: %s" % ex.getMessage()
+            return 1
+
+    def _add_concurrency_option(self, parser):
+        """ Adds the option to reconfigure several virtual machines """
+        parser.add_option("-c", "--concurrency", dest="concurrency",
+                type="int", default=10,
+                help=("The maximum number of virtual machines to "
+                "reconfigure at the same time (default: 10)"))
+
+    def _find_volumes(self, names):
+        """ Finds the volumes with the given names.
+
+        Returns None if any of them is not found.
+        """
+        volumes = []
+        for name in names:
+            volume = helper.find_volume(self._context, name)
+            if not volume:
+                print "No volume found with name: %s" % name
+                return None
+            volumes.append(volume)
+        return volumes
+
+    def _reconfigure(self, targets, change, action, concurrency):
+        """ Changes the disks of several virtual machines concurrently.
+
+        Each target is a (vm, volumes) tuple, and the change function
+        returns the new disks of the virtual machine given the current
+        ones and the volumes. Each virtual machine is reconfigured only
+        once, however many volumes change. Returns 1 if any of them could
+        not be reconfigured.
+        """
+        running = [vm for vm, volumes in targets
+                if vm.getState().existsInHypervisor()]
+        if running:
+            print "%s volumes of %s running virtual machines." % (action,
+                    len(running)),
+            print "This may take some time..."
+
+        def reconfigure(target):
+            vm, volumes = target
+            log.debug("%s volumes %s of %s..." % (action,
+                ", ".join([volume.getName() for volume in volumes]),
+                vm.getInternalName()))
+            vm.setVirtualDisks(change(list(vm.listVirtualDisks()), volumes))
+            return helper.refresh_volumes(self._context,
+                    vm.getVirtualDatacenter(), volumes)
+
+        refreshed = []
+        failed = 0
+        for (vm, volumes), result, error in imap(reconfigure, targets,
+                concurrency):
+            if error:
+                print "Could not reconfigure %s: %s" % (vm.getInternalName(),
+                        error)
+                failed += 1
+            else:
+                refreshed.extend(result)
+        if refreshed:
+            pprint_volumes(refreshed)
+        return 1 if failed else None
+
+
+def parse_names(text):
+    """ Parses a comma separated list of names """
+    return [name.strip() for name in text.split(",") if name.strip()]
+
+
+def parse_target(text):
+    """ Parses a <vm>=<volume>,<volume>... pair """
+    if "=" not in text:
+        raise ValueError("Invalid virtual machine and volumes: %s" % text)
+    vm, names = text.split("=", 1)
+    names = parse_names(names)
+    if not vm.strip() or not names:
+        raise ValueError("Invalid virtual machine and volumes: %s" % text)
+    return (vm.strip(), names)
 
 
 def load():
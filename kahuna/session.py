@@ -1,9 +1,14 @@
 #!/usr/bin/env jython
 
 import atexit
+import copy
 import logging
+import threading
+import time
 
 from config import Config
+from utils.singleton import singleton
+from java.lang import Throwable
 from java.util import Properties
 from org.jclouds import ContextBuilder
 from org.jclouds.abiquo import AbiquoApiMetadata, AbiquoContext
@@ -24,7 +29,8 @@ class ContextLoader:
     def __init__(self, overrides=None):
         """ Sets the properties and context builders """
         self.__context = None
-        self.__config = Config()
+        # Work on a copy so overrides do not leak to other contexts
+        self.__config = copy.copy(Config())
         if overrides:
             log.debug("Overriding default config values")
             for property in sorted(overrides.iterkeys()):
@@ -32,10 +38,15 @@ class ContextLoader:
 
     def __del__(self):
         """ Closes the context before destroying """
+        self.close()
+
+    def close(self):
+        """ Closes the context if it is open """
         if self.__context:
             log.debug("Disconnecting from %s" % self.__context. \
                     getApiContext().getEndpoint())
             self.__context.close()
+            self.__context = None
 
     def load(self):
         """ Creates and configures the context """
@@ -63,3 +74,132 @@ class ContextLoader:
         [props.put(name, value)
                 for (name, value) in self.__config.client_config]
         return props
+
+
+@singleton
+class ContextPool:
+    """ Keeps the contexts open to reuse them between commands.
+
+    Contexts are indexed by the connection settings, so all commands
+    targeting the same endpoint with the same credentials share the
+    authenticated connections. Contexts that have not been used for a
+    while are closed, and the ones that have been idle are checked
+    before lending them again.
+    """
+
+    def __init__(self):
+        """ Initializes the pool with the configured timeouts """
+        config = Config()
+        self.__idle_timeout = config.pool_idle_timeout
+        self.__check_interval = config.pool_check_interval
+        self.__entries = {}
+        self.__lock = threading.RLock()
+
+    def borrow(self, overrides=None):
+        """ Returns an open context for the given configuration overrides.
+
+        The context must be given back with the release method once the
+        caller is done with it, and must not be closed.
+        """
+        key = _context_key(overrides)
+        self.__lock.acquire()
+        try:
+            self.evict_idle()
+            entry = self.__entries.get(key)
+            if entry and entry.borrowed == 0 and \
+                    entry.idle_time() > self.__check_interval and \
+                    not _is_healthy(entry.context):
+                log.debug("Discarding unhealthy context for %s" % key[0])
+                self.__discard(key)
+                entry = None
+            if not entry:
+                log.debug("Opening a new context for %s" % key[0])
+                loader = ContextLoader(overrides)
+                entry = _PooledContext(key, loader, loader.load())
+                self.__entries[key] = entry
+            entry.borrowed += 1
+            return entry.context
+        finally:
+            self.__lock.release()
+
+    def release(self, context):
+        """ Gives back a context previously borrowed from the pool """
+        self.__lock.acquire()
+        try:
+            for entry in self.__entries.values():
+                if entry.context is context:
+                    entry.borrowed -= 1
+                    entry.last_used = time.time()
+                    return
+            # Not pooled (it may have been discarded): just close it
+            context.close()
+        finally:
+            self.__lock.release()
+
+    def evict_idle(self):
+        """ Closes the contexts that have not been used for a while """
+        self.__lock.acquire()
+        try:
+            for key, entry in self.__entries.items():
+                if entry.borrowed == 0 and \
+                        entry.idle_time() > self.__idle_timeout:
+                    log.debug("Closing idle context for %s" % key[0])
+                    self.__discard(key)
+        finally:
+            self.__lock.release()
+
+    def size(self):
+        """ Returns the number of open contexts """
+        return len(self.__entries)
+
+    def close(self):
+        """ Closes all the contexts in the pool """
+        self.__lock.acquire()
+        try:
+            for key in self.__entries.keys():
+                self.__discard(key)
+        finally:
+            self.__lock.release()
+
+    def __discard(self, key):
+        """ Removes the context with the given key and closes it """
+        entry = self.__entries.pop(key)
+        try:
+            entry.loader.close()
+        except (Exception, Throwable), ex:
+            log.debug("Error closing context: %s" % ex)
+
+
+class _PooledContext:
+    """ A context in the pool and its usage information """
+
+    def __init__(self, key, loader, context):
+        self.key = key
+        self.loader = loader
+        self.context = context
+        self.borrowed = 0
+        self.last_used = time.time()
+
+    def idle_time(self):
+        """ Returns the seconds since the context was last released """
+        return time.time() - self.last_used
+
+
+def _is_healthy(context):
+    """ Checks that the context can still talk to the API """
+    try:
+        context.getAdministrationService().getCurrentUser()
+        return True
+    except (Exception, Throwable), ex:
+        log.debug("Context health check failed: %s" % ex)
+        return False
+
+
+def _context_key(overrides):
+    """ Builds the key that identifies the connection settings """
+    config = copy.copy(Config())
+    if overrides:
+        for property in overrides.iterkeys():
+            setattr(config, property, overrides[property])
+    return (config.address, config.user, config.password,
+            tuple(sorted(config.client_config)))
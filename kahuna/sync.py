@@ -0,0 +1,386 @@
+#!/usr/bin/env jython
+
+import logging
+import threading
+import time
+from java.lang import Throwable
+from com.abiquo.server.core.appslibrary import VirtualMachineTemplatesDto
+from com.abiquo.server.core.cloud import VirtualAppliancesDto
+from com.abiquo.server.core.cloud import VirtualDatacentersDto
+from com.abiquo.server.core.cloud import VirtualMachinesWithNodeExtendedDto
+from com.abiquo.server.core.infrastructure import DatacentersDto
+from com.abiquo.server.core.infrastructure import MachinesDto
+from com.abiquo.server.core.infrastructure import RacksDto
+from com.abiquo.server.core.infrastructure.storage import VolumesManagementDto
+from com.google.common.collect import LinkedHashMultimap
+from com.google.common.io import ByteStreams
+from org.jclouds.abiquo.http.filters import AbiquoAuthentication
+from org.jclouds.http import HttpRequest
+from kahuna.utils.parallel import imap
+
+log = logging.getLogger('kahuna')
+
+# The maximum number of collections fetched at the same time
+PARALLELISM = 10
+
+# Snapshots are only reused when several commands run in the same process
+_keep_snapshots = False
+
+# The sync engines of this process, by endpoint and user
+_engines = {}
+_engines_lock = threading.Lock()
+
+
+def keep_snapshots():
+    """ Reuses the snapshots in the following commands.
+
+    It is called by the daemon and batch modes. A single command lists
+    each collection only once, so it uses the plain listings instead.
+    """
+    global _keep_snapshots
+    _keep_snapshots = True
+
+
+def sync(context):
+    """ Returns the sync engine for the endpoint and user of the context """
+    api_context = context.getApiContext()
+    key = "%s %s" % (api_context.getEndpoint(), api_context.getIdentity())
+    _engines_lock.acquire()
+    try:
+        engine = _engines.get(key)
+        if not engine:
+            engine = SyncEngine()
+            _engines[key] = engine
+        engine._set_context(context)
+        return engine
+    finally:
+        _engines_lock.release()
+
+
+class SyncEngine:
+    """ Keeps a snapshot of the collections of the API up to date.
+
+    Before fetching a collection again, its URI is requested with the
+    ETag and Last-Modified headers of the previous response. If the API
+    answers that it has not been modified, the entities of the snapshot
+    are reused instead of being fetched and built again. Collections that
+    are not in the snapshot, or whose responses have neither header, are
+    fetched without checking them first. The
+    collections of each entity (such as the virtual machines of each
+    virtual appliance) are checked the same way, and discarded when the
+    entity is removed.
+
+    Snapshots hold entities bound to a context, so they are discarded
+    when the context changes. They are kept in memory, which is useful
+    when running in daemon or batch mode.
+    """
+
+    def __init__(self):
+        """ Initializes an empty snapshot """
+        self.__context = None
+        self.__snapshots = {}
+        self.__stats = SyncStats()
+        self.__lock = threading.RLock()
+
+    def _set_context(self, context):
+        """ Sets the context, discarding the snapshots of the previous one """
+        self.__lock.acquire()
+        try:
+            if self.__context is not context:
+                self.__snapshots = {}
+                self.__context = context
+        finally:
+            self.__lock.release()
+
+    def stats(self):
+        """ Returns the accumulated sync statistics """
+        return self.__stats
+
+    def collection(self, key, href, media_type, fetch, kind=None):
+        """ Returns the entities of a collection, fetching them if needed.
+
+        The href and media type identify the collection in the API, and
+        the fetch function returns its entities. The kind of the entities
+        is used to discard the collections that depend on them when they
+        are removed.
+        """
+        start = time.time()
+        snapshot = self.__snapshots.get(key)
+        validators, size, probed = (None, 0, False)
+        # Without a snapshot there is nothing to compare with, so the
+        # collection is fetched straight away
+        if snapshot and snapshot.validators:
+            status, validators, size = self.__probe("GET", href, media_type,
+                    snapshot.validators)
+            probed = True
+            if status == 304 or status == 200 and \
+                    validators == snapshot.validators:
+                log.debug("Collection %s not modified" % key)
+                self.__stats.count(False, 0, True, size,
+                        time.time() - start)
+                return snapshot.entities
+            # The same contents are fetched again by jclouds
+            size = size * 2
+        elif snapshot and snapshot.validators is None:
+            # The validators are only known once the collection has been
+            # requested, so they are read from the headers of a HEAD
+            status, validators, size = self.__probe("HEAD", href, media_type)
+            probed = True
+            if status == 200 and not validators:
+                log.debug("Collection %s has no validators" % key)
+                validators = False
+        elif snapshot:
+            # The API does not send validators for this collection, and
+            # probing it would download it twice
+            validators = False
+
+        entities = list(fetch())
+        self.__lock.acquire()
+        try:
+            if snapshot:
+                ids = [entity.getId() for entity in entities]
+                for entity in snapshot.entities:
+                    if entity.getId() not in ids:
+                        self.__drop_children(snapshot.kind, entity)
+            self.__snapshots[key] = _Snapshot(validators, entities, kind)
+        finally:
+            self.__lock.release()
+        self.__stats.count(True, len(entities), probed, size,
+                time.time() - start)
+        return entities
+
+    def children(self, parent_kind, parents, rel, media_type, fetch,
+            kind=None):
+        """ Returns the entities of the given collection of each parent.
+
+        The collection of each parent is the one referenced by its link
+        with the given rel, and the fetch function returns its entities
+        given the parent. The collections of all the parents are checked
+        in parallel, and their entities returned in the order of the
+        parents.
+        """
+        def parent_collection(parent):
+            link = parent.unwrap().searchLink(rel)
+            return self.collection(
+                    "%s/%s/%s" % (parent_kind, parent.getId(), rel),
+                    link and link.getHref(), media_type,
+                    lambda: fetch(parent), kind)
+
+        parents = list(parents)
+        collections = {}
+        for parent, entities, error in imap(parent_collection, parents,
+                PARALLELISM):
+            if error:
+                raise error
+            collections[parent.getId()] = entities
+        entities = []
+        for parent in parents:
+            entities.extend(collections[parent.getId()])
+        return entities
+
+    def clear(self):
+        """ Discards all the snapshots """
+        self.__lock.acquire()
+        try:
+            self.__snapshots = {}
+        finally:
+            self.__lock.release()
+
+    def __drop_children(self, kind, entity):
+        """ Discards the collections of a removed entity """
+        if not kind:
+            return
+        prefix = "%s/%s/" % (kind, entity.getId())
+        for key in self.__snapshots.keys():
+            if key.startswith(prefix):
+                snapshot = self.__snapshots.pop(key, None)
+                for child in snapshot and snapshot.entities or []:
+                    self.__drop_children(snapshot.kind, child)
+
+    def __probe(self, method, href, media_type, validators=None):
+        """ Requests the collection, only if it has changed when the
+        validators of the snapshot are given.
+
+        Returns the status code, the validators of the response (its ETag
+        and Last-Modified headers, or None if it has none) and the number
+        of bytes received. The status code is None if the collection
+        could not be requested.
+        """
+        if not href:
+            return (None, None, 0)
+        api_context = self.__context.getApiContext()
+        headers = LinkedHashMultimap.create()
+        headers.put("Accept", media_type)
+        etag, last_modified = validators or (None, None)
+        if etag:
+            headers.put("If-None-Match", etag)
+        if last_modified:
+            headers.put("If-Modified-Since", last_modified)
+        request = HttpRequest.builder().method(method).endpoint(href) \
+                .headers(headers).build()
+        try:
+            request = api_context.getUtils().getInjector() \
+                    .getInstance(AbiquoAuthentication).filter(request)
+            response = api_context.getUtils().getHttpClient().invoke(request)
+            try:
+                status = response.getStatusCode()
+                if status == 304:
+                    return (status, validators, 0)
+                received = (response.getFirstHeaderOrNull("ETag"),
+                        response.getFirstHeaderOrNull("Last-Modified"))
+                if received == (None, None):
+                    received = None
+                size = 0
+                if method == "HEAD":
+                    # The size of the contents that will be fetched
+                    length = response.getFirstHeaderOrNull("Content-Length")
+                    size = length and int(length) or 0
+                elif response.getPayload():
+                    size = len(ByteStreams.toByteArray(
+                        response.getPayload().getInput()))
+                return (status, received, size)
+            finally:
+                if response.getPayload():
+                    response.getPayload().release()
+        except (Exception, Throwable), ex:
+            log.debug("Could not check collection %s: %s" % (href, ex))
+            return (None, None, 0)
+
+
+class SyncStats:
+    """ Statistics of the collections checked by a sync engine.
+
+    The bytes are the ones received when checking if a collection has
+    changed, plus the ones fetched again by jclouds when it has. The size
+    of the collections that are not in the snapshot yet is not known, so
+    they are only counted as fetched.
+    """
+
+    def __init__(self):
+        self.checked = 0
+        self.probed = 0
+        self.fetched = 0
+        self.entities = 0
+        self.bytes = 0
+        self.seconds = 0.0
+        self.__lock = threading.Lock()
+
+    def count(self, fetched, entities, probed, size, seconds):
+        """ Accounts a collection check """
+        self.__lock.acquire()
+        try:
+            self.checked += 1
+            if probed:
+                self.probed += 1
+            if fetched:
+                self.fetched += 1
+            self.entities += entities
+            self.bytes += size
+            self.seconds += seconds
+        finally:
+            self.__lock.release()
+
+
+class _Snapshot:
+    """ The entities of a collection and the version they belong to """
+
+    def __init__(self, validators, entities, kind):
+        # The ETag and Last-Modified headers, None if they are not known
+        # yet, or False if the API does not send them
+        self.validators = validators
+        self.entities = entities
+        self.kind = kind
+
+
+def list_virtual_datacenters(context):
+    """ Lists the virtual datacenters """
+    cloud = context.getCloudService()
+    return sync(context).collection("vdcs",
+            _endpoint(context, "/cloud/virtualdatacenters"),
+            VirtualDatacentersDto.MEDIA_TYPE, cloud.listVirtualDatacenters,
+            "vdc")
+
+
+def list_virtual_appliances(context, vdcs=None):
+    """ Lists the virtual appliances of the given virtual datacenters (all
+    of them by default) """
+    if vdcs is None:
+        vdcs = list_virtual_datacenters(context)
+    return sync(context).children("vdc", vdcs,
+            "virtualappliances", VirtualAppliancesDto.MEDIA_TYPE,
+            lambda vdc: vdc.listVirtualAppliances(), "vapp")
+
+
+def list_virtual_machines(context, vdcs=None, vapps=None):
+    """ Lists the virtual machines of the given virtual datacenters (all
+    of them by default). The virtual appliances of the virtual
+    datacenters can be given if they have already been listed. """
+    if not _keep_snapshots:
+        # The plain listing already fetches the collections concurrently
+        vms = context.getCloudService().listVirtualMachines()
+        if vdcs is None:
+            return vms
+        ids = [vdc.getId() for vdc in vdcs]
+        return [vm for vm in vms
+                if _link_id(vm, "virtualdatacenter") in ids]
+    if vapps is None:
+        vapps = list_virtual_appliances(context, vdcs)
+    return sync(context).children("vapp", vapps, "virtualmachines",
+            VirtualMachinesWithNodeExtendedDto.MEDIA_TYPE,
+            lambda vapp: vapp.listVirtualMachines())
+
+
+def list_volumes(context, vdcs=None):
+    """ Lists the volumes of the given virtual datacenters (all of them by
+    default) """
+    if vdcs is None:
+        vdcs = list_virtual_datacenters(context)
+    return sync(context).children("vdc", vdcs,
+            "volumes", VolumesManagementDto.MEDIA_TYPE,
+            lambda vdc: vdc.listVolumes())
+
+
+def list_machines(context):
+    """ Lists the physical machines of all datacenters """
+    engine = sync(context)
+    racks = engine.children("dc", _list_datacenters(context), "racks",
+            RacksDto.MEDIA_TYPE, lambda dc: dc.listRacks(), "rack")
+    return engine.children("rack", racks, "machines", MachinesDto.MEDIA_TYPE,
+            lambda rack: rack.listMachines())
+
+
+def list_templates(context):
+    """ Lists the templates of the current enterprise """
+    admin = context.getAdministrationService()
+    enterprise = admin.getCurrentEnterprise()
+    engine = sync(context)
+    link = enterprise.unwrap().searchLink("datacenterrepositories")
+    templates = []
+    for dc in _list_datacenters(context):
+        href = link and "%s/%s/virtualmachinetemplates" % (link.getHref(),
+                dc.getId())
+        templates.extend(engine.collection(
+            "dc/%s/templates/%s" % (dc.getId(), enterprise.getId()),
+            href, VirtualMachineTemplatesDto.MEDIA_TYPE,
+            lambda dc=dc: enterprise.listTemplatesInRepository(dc)))
+    return templates
+
+
+def _list_datacenters(context):
+    """ Lists the datacenters """
+    admin = context.getAdministrationService()
+    return sync(context).collection("dcs",
+            _endpoint(context, "/admin/datacenters"),
+            DatacentersDto.MEDIA_TYPE, admin.listDatacenters, "dc")
+
+
+def _link_id(entity, rel):
+    """ Gets the id of the entity referenced by the given link """
+    link = entity.unwrap().searchLink(rel)
+    return int(link.getHref().rstrip("/").split("/")[-1]) if link else None
+
+
+def _endpoint(context, path):
+    """ Returns the URI of the given path of the API """
+    return "%s%s" % (str(context.getApiContext().getEndpoint()).rstrip("/"),
+            path)
@@ -0,0 +1,164 @@
+#!/usr/bin/env jython
+
+import logging
+import os
+import pickle
+import socket
+import threading
+from kahuna.utils.parallel import WorkerPool
+from kahuna.utils.parallel import imap
+from com.abiquo.model.enumerator import HypervisorType
+
+log = logging.getLogger('kahuna')
+
+# The port each hypervisor (or its Abiquo agent) listens to, and the
+# beginning of its greeting, if it sends one
+FINGERPRINTS = [
+    ("VMX_04", 902, "220 VMware"),
+    ("HYPERV_301", 5985, None),
+    ("KVM", 60606, None),
+    ("XEN_3", 60606, None),
+    ("VBOX", 18083, None),
+    ("XENSERVER", 443, None),
+]
+
+# Seconds to wait when checking the ports of a host
+FINGERPRINT_TIMEOUT = 2
+
+# Discovery errors that will happen with any hypervisor type
+FATAL_ERRORS = ["NC-3", "RS-2"]
+
+# The file with the type of the hosts discovered so far
+CACHE_FILE = "%s/.kahuna/hypervisors.cache" % os.environ['HOME']
+_cache_lock = threading.Lock()
+
+
+def discover_machine(datacenter, host, user, password, types=None):
+    """ Discovers the machine at the given host.
+
+    If no hypervisor types are given, the type cached from a previous
+    discovery of the host is tried first. Then the types whose ports are
+    open in the host, and finally the rest of them. The types of each of
+    these stages are tried concurrently, and the first one that succeeds
+    cancels the rest.
+
+    Returns the machine, or None if it could not be discovered. Errors
+    that do not depend on the hypervisor type are raised.
+    """
+    if types:
+        stages = [types]
+    else:
+        stages = _stages(host)
+    for stage in stages:
+        machine = _probe(datacenter, host, user, password, stage)
+        if machine:
+            _remember(host, machine.getType().name())
+            return machine
+    return None
+
+
+def fingerprint(host):
+    """ Returns the hypervisor types whose ports are open in the host """
+    def check(fp):
+        name, port, banner = fp
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.settimeout(FINGERPRINT_TIMEOUT)
+        try:
+            sock.connect((host, port))
+            if banner:
+                return sock.recv(len(banner)) == banner
+            return True
+        finally:
+            sock.close()
+
+    names = []
+    for fp, matches, error in imap(check, FINGERPRINTS, len(FINGERPRINTS)):
+        if matches:
+            names.append(fp[0])
+    # Keep the order of the fingerprints
+    return [fp[0] for fp in FINGERPRINTS if fp[0] in names]
+
+
+def _stages(host):
+    """ Returns the groups of hypervisor types to try, in order """
+    available = dict([(type.name(), type) for type in HypervisorType.values()])
+    stages = []
+    cached = _cached(host)
+    if cached in available:
+        log.debug("Host %s was found to be %s" % (host, cached))
+        stages.append([available.pop(cached)])
+    matches = [available.pop(name) for name in fingerprint(host)
+            if name in available]
+    if matches:
+        log.debug("Host %s looks like %s" % (host,
+            ", ".join([type.name() for type in matches])))
+        stages.append(matches)
+    if available:
+        stages.append(available.values())
+    return stages
+
+
+def _probe(datacenter, host, user, password, types):
+    """ Discovers the machine trying all the given types concurrently """
+    pool = WorkerPool(len(types))
+    try:
+        for type in types:
+            log.debug("Trying hypervisor %s" % type.name())
+            pool.submit(type, datacenter.discoverSingleMachine, host, type,
+                    user, password)
+        for type, machine, error in pool.results():
+            if not error:
+                pool.cancel()
+                return machine
+            if hasattr(error, "hasError") and \
+                    [code for code in FATAL_ERRORS if error.hasError(code)]:
+                pool.cancel()
+                raise error
+            log.debug("Host %s is not %s: %s" % (host, type.name(),
+                str(error).replace("\n", "")))
+        return None
+    finally:
+        pool.shutdown()
+
+
+def _cached(host):
+    """ Returns the type the host was discovered with, if any """
+    return _load().get(host)
+
+
+def _remember(host, name):
+    """ Caches the type the host was discovered with """
+    _cache_lock.acquire()
+    try:
+        types = _load()
+        if types.get(host) == name:
+            return
+        types[host] = name
+        try:
+            directory = os.path.dirname(CACHE_FILE)
+            if not os.path.isdir(directory):
+                os.makedirs(directory)
+            f = open(CACHE_FILE, "wb")
+            try:
+                pickle.dump(types, f)
+            finally:
+                f.close()
+        except Exception, ex:
+            log.debug("Could not write the hypervisor cache: %s" % ex)
+    finally:
+        _cache_lock.release()
+
+
+def _load():
+    """ Loads the cached hypervisor types by host """
+    if not os.path.exists(CACHE_FILE):
+        return {}
+    try:
+        f = open(CACHE_FILE, "rb")
+        try:
+            return pickle.load(f)
+        finally:
+            f.close()
+    except Exception, ex:
+        log.debug("Could not read the hypervisor cache: %s" % ex)
+        return {}
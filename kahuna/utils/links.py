@@ -0,0 +1,40 @@
+#!/usr/bin/env jython
+
+
+class LinkCache:
+    """ Identity map of the entities referenced by links.
+
+    Getting a related entity (such as the template of a virtual machine)
+    follows a link with a request to the API. When many entities point
+    to the same ones, the cache resolves each link only once. It is meant
+    to be used for a single command, so it never expires.
+    """
+
+    def __init__(self):
+        """ Initializes an empty cache """
+        self.__entities = {}
+
+    def prefetch(self, entities):
+        """ Adds the given entities to the cache.
+
+        Use it with collections that have already been listed, so links
+        to them do not need any request.
+        """
+        for entity in entities:
+            link = entity.unwrap().getEditLink()
+            if link:
+                self.__entities[link.getHref()] = entity
+
+    def follow(self, entity, rel, getter):
+        """ Returns the entity referenced by the given link.
+
+        The getter is the method of the entity that fetches it, and is
+        only called if the link has not been resolved yet.
+        """
+        link = entity.unwrap().searchLink(rel)
+        if not link:
+            return getter()
+        href = link.getHref()
+        if href not in self.__entities:
+            self.__entities[href] = getter()
+        return self.__entities[href]
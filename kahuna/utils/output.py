@@ -0,0 +1,178 @@
+#!/usr/bin/env jython
+
+import csv
+import gzip
+import os
+import sys
+
+# The available output formats. The table is printed by PTable
+FORMATS = ["table", "ndjson", "csv", "tsv"]
+
+
+def add_output_options(parser):
+    """ Adds the options to choose the output of a listing """
+    parser.add_option("--output", dest="output", type="choice",
+            choices=FORMATS, default="table",
+            help="The output format: %s (default: table)" %
+            "|".join(FORMATS))
+    parser.add_option("--output-file", dest="output_file",
+            help=("The file to write the output to. It is compressed if "
+            "it ends with .gz (default: stdout)"))
+
+
+class Output:
+    """ The format and destination of the output of a listing.
+
+    Rows in the ndjson, csv and tsv formats are written as soon as they
+    are added, without buffering them to compute the column widths, so
+    big listings can be exported in constant memory.
+    """
+
+    def __init__(self, format="table", path=None):
+        """ Initializes the output to write to the given file or stdout """
+        self.format = format
+        self.__path = path
+        self.__file = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.close()
+
+    def stream(self):
+        """ Returns the stream to write to, opening the file if needed """
+        if not self.__path:
+            return sys.stdout
+        if not self.__file:
+            path = os.path.join(os.environ.get("KAHUNA_CWD", ""),
+                    self.__path)
+            if path.endswith(".gz"):
+                self.__file = gzip.open(path, "wb")
+            else:
+                self.__file = open(path, "wb")
+        return self.__file
+
+    def writer(self, names):
+        """ Returns a writer for rows with the given column names """
+        if self.format == "ndjson":
+            return NdjsonWriter(names, self.stream())
+        if self.format == "csv":
+            return CsvWriter(names, self.stream())
+        if self.format == "tsv":
+            return TsvWriter(names, self.stream())
+        raise ValueError("Unsupported output format: %s" % self.format)
+
+    def close(self):
+        """ Closes the output file, if any """
+        if self.__file:
+            self.__file.close()
+            self.__file = None
+
+
+class NdjsonWriter:
+    """ Writes each row as a JSON object in its own line """
+
+    def __init__(self, names, out):
+        self.__names = names
+        self.__out = out
+
+    def add(self, row):
+        fields = ["%s: %s" % (to_json(name), to_json(value))
+                for (name, value) in zip(self.__names, row)]
+        self.__out.write("{%s}\n" % ", ".join(fields))
+
+    def separator(self, position=-1):
+        pass
+
+    def pprint(self):
+        self.__out.flush()
+
+
+class CsvWriter:
+    """ Writes the rows as comma separated values, with a header """
+
+    def __init__(self, names, out):
+        self.__out = out
+        self.__writer = csv.writer(out, lineterminator="\n")
+        self.__writer.writerow(names)
+
+    def add(self, row):
+        self.__writer.writerow([_cell(value) for value in row])
+
+    def separator(self, position=-1):
+        pass
+
+    def pprint(self):
+        self.__out.flush()
+
+
+class TsvWriter:
+    """ Writes the rows as tab separated values, with a header """
+
+    def __init__(self, names, out):
+        self.__out = out
+        self.__out.write("\t".join(names) + "\n")
+
+    def add(self, row):
+        # Tabs and line breaks in the values would break the format
+        values = [_cell(value).replace("\t", " ").replace("\n", " ")
+                for value in row]
+        self.__out.write("\t".join(values) + "\n")
+
+    def separator(self, position=-1):
+        pass
+
+    def pprint(self):
+        self.__out.flush()
+
+
+def to_json(value):
+    """ Encodes a value as JSON.
+
+    Numbers, booleans and None are encoded as such, lists and tuples as
+    arrays, dicts as objects and any other value as its string.
+    """
+    if value is None:
+        return "null"
+    if value is True:
+        return "true"
+    if value is False:
+        return "false"
+    if isinstance(value, (int, long, float)):
+        return repr(value).rstrip("L")
+    if isinstance(value, (list, tuple)):
+        return "[%s]" % ", ".join([to_json(item) for item in value])
+    if isinstance(value, dict):
+        return "{%s}" % ", ".join(["%s: %s" % (to_json(str(key)),
+            to_json(item)) for (key, item) in value.items()])
+    text = _text(value)
+    chars = []
+    for char in text:
+        if char == '"' or char == "\\":
+            chars.append("\\" + char)
+        elif char == "\n":
+            chars.append("\\n")
+        elif char == "\r":
+            chars.append("\\r")
+        elif char == "\t":
+            chars.append("\\t")
+        elif ord(char) < 0x20:
+            chars.append("\\u%04x" % ord(char))
+        else:
+            chars.append(char)
+    return '"%s"' % "".join(chars)
+
+
+def _text(value):
+    """ Returns the given value as a string encoded in UTF-8 """
+    if isinstance(value, unicode):
+        return value.encode("utf-8")
+    return str(value)
+
+
+def _cell(value):
+    """ Returns the given value as a delimited cell """
+    if value is None:
+        return ""
+    return _text(value)
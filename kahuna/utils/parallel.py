@@ -0,0 +1,204 @@
+#!/usr/bin/env jython
+
+import logging
+import time
+from java.lang import Throwable
+from java.util.concurrent import Callable
+from java.util.concurrent import ExecutorCompletionService
+from java.util.concurrent import Executors
+from java.util.concurrent import TimeUnit
+
+log = logging.getLogger('kahuna')
+
+
+class TaskTimeout(Exception):
+    """ Raised when a task does not finish in the given time """
+    pass
+
+
+class WorkerPool:
+    """ Runs tasks concurrently in a bounded pool of threads.
+
+    Results are returned in completion order as (key, result, error)
+    tuples, where error is None if the task succeeded or the raised
+    exception otherwise. Both Python and Java exceptions are captured.
+    """
+
+    def __init__(self, size):
+        """ Creates a pool with the given number of threads """
+        self.__executor = Executors.newFixedThreadPool(max(size, 1))
+        self.__completion = ExecutorCompletionService(self.__executor)
+        self.__pending = {}
+
+    def submit(self, key, func, *args):
+        """ Schedules func(*args). The key identifies its result """
+        task = _Task(key, func, args)
+        future = self.__completion.submit(task)
+        self.__pending[future] = task
+
+    def pending(self):
+        """ Returns the number of tasks that have not been collected """
+        return len(self.__pending)
+
+    def results(self, timeout=None):
+        """ Yields the results of the tasks as they finish.
+
+        If a timeout (in seconds) is given, tasks running for longer are
+        cancelled and reported with a TaskTimeout error.
+        """
+        while self.__pending:
+            if timeout:
+                future = self.__completion.poll(
+                        long(self.__next_deadline(timeout) * 1000),
+                        TimeUnit.MILLISECONDS)
+            else:
+                future = self.__completion.take()
+            if future:
+                # Cancelled futures are still queued once they finish, but
+                # they have already been reported
+                task = self.__pending.pop(future, None)
+                if task and not future.isCancelled():
+                    result, error = future.get()
+                    yield (task.key, result, error)
+            if timeout:
+                for expired in self.__expired(timeout):
+                    yield expired
+
+    def cancel(self):
+        """ Cancels the tasks that have not been collected yet """
+        for future in self.__pending.keys():
+            future.cancel(True)
+        self.__pending.clear()
+
+    def shutdown(self):
+        """ Stops the threads once the running tasks finish """
+        self.__executor.shutdown()
+
+    def __next_deadline(self, timeout):
+        """ Seconds until the first running task times out """
+        now = time.time()
+        started = [t.started for t in self.__pending.values() if t.started]
+        if not started:
+            return timeout
+        return max(min(started) + timeout - now, 0.01)
+
+    def __expired(self, timeout):
+        """ Cancels the tasks running for longer than the timeout """
+        now = time.time()
+        for future, task in self.__pending.items():
+            if task.started and now - task.started > timeout:
+                log.debug("Cancelling %s after %s seconds" %
+                        (task.key, timeout))
+                future.cancel(True)
+                del self.__pending[future]
+                yield (task.key, None,
+                        TaskTimeout("Timed out after %s seconds" % timeout))
+
+
+class _Task(Callable):
+    """ Wraps a Python function to run it in a Java executor """
+
+    def __init__(self, key, func, args):
+        self.key = key
+        self.started = None
+        self.__func = func
+        self.__args = args
+
+    def call(self):
+        self.started = time.time()
+        try:
+            return (self.__func(*self.__args), None)
+        except (Exception, SystemExit, Throwable), ex:
+            log.debug("Task %s failed: %s" % (self.key, ex))
+            return (None, ex)
+
+
+def imap(func, items, parallelism, timeout=None):
+    """ Applies func to each item using at most parallelism threads.
+
+    Yields (item, result, error) tuples in completion order.
+    """
+    pool = WorkerPool(parallelism)
+    try:
+        for item in items:
+            pool.submit(item, func, item)
+        for result in pool.results(timeout):
+            yield result
+    finally:
+        pool.shutdown()
+
+
+class TaskGraph:
+    """ Runs tasks that depend on the results of other tasks.
+
+    Each task runs in a WorkerPool as soon as all its dependencies have
+    succeeded, and gets their results as arguments, in the order they
+    were declared. The tasks that depend on a failed task are skipped.
+    Dependencies must be added before the tasks that need them, so the
+    graph can not have cycles.
+    """
+
+    def __init__(self):
+        """ Creates an empty graph """
+        self.__names = []
+        self.__tasks = {}
+
+    def add(self, name, func, depends=None):
+        """ Adds a task that runs func with the results of its dependencies """
+        if name in self.__tasks:
+            raise ValueError("Duplicated task: %s" % name)
+        for dependency in depends or []:
+            if dependency not in self.__tasks:
+                raise ValueError("Unknown dependency of %s: %s" %
+                        (name, dependency))
+        self.__names.append(name)
+        self.__tasks[name] = (func, depends or [])
+
+    def run(self, parallelism):
+        """ Runs the tasks using at most parallelism threads.
+
+        Returns a (name, status, seconds, error) tuple for each task, in
+        the order they were added. The status is OK, ERROR or SKIPPED.
+        """
+        results = {}
+        reports = {}
+        started = {}
+        waiting = list(self.__names)
+
+        def timed(name, func, args):
+            started[name] = time.time()
+            return func(*args)
+
+        def schedule():
+            for name in list(waiting):
+                func, depends = self.__tasks[name]
+                failed = [d for d in depends if d in reports and
+                        reports[d][1] != "OK"]
+                if failed:
+                    waiting.remove(name)
+                    reports[name] = (name, "SKIPPED", None,
+                            "Depends on %s" % failed[0])
+                elif len([d for d in depends if d in results]) == \
+                        len(depends):
+                    waiting.remove(name)
+                    pool.submit(name, timed, name, func,
+                            [results[d] for d in depends])
+
+        pool = WorkerPool(parallelism)
+        try:
+            schedule()
+            for name, result, error in pool.results():
+                seconds = time.time() - started.get(name, time.time())
+                if error:
+                    log.debug("Task %s failed after %.2f seconds" %
+                            (name, seconds))
+                    reports[name] = (name, "ERROR", seconds, error)
+                else:
+                    log.debug("Task %s finished in %.2f seconds" %
+                            (name, seconds))
+                    results[name] = result
+                    reports[name] = (name, "OK", seconds, None)
+                schedule()
+        finally:
+            pool.shutdown()
+        return [reports[name] for name in self.__names]
@@ -1,14 +1,33 @@
 #!/usr/bin/env jython
 
+import itertools
+import sys
 from datetime import datetime
+from kahuna.utils.links import LinkCache
+
+# Number of rows used to compute the column widths of streamed tables
+STREAM_SAMPLE = 50
 
 
 class PTable:
     """ Table with pretty formatting """
-    def __init__(self, headers=[]):
+    def __init__(self, headers=[], widths=None, sample=None, out=None):
+        """ Creates the table.
+
+        If the column widths are given, rows are printed as soon as they
+        are added instead of waiting for all of them to compute the width
+        of each column. If a sample size is given instead, the widths are
+        computed from the first rows, and the rest are printed as soon as
+        they are added. Values wider than their column are not truncated.
+        The table is written to the given stream (stdout by default).
+        """
         self._headers = headers
         self._rows = []
         self._separators = []
+        self._widths = widths
+        self._sample = sample
+        self._out = out
+        self._header_printed = False
 
     def headers(self, headers):
         """ Sets the table headers """
@@ -16,18 +35,37 @@ class PTable:
 
     def add(self, row):
         """ Adds a row to the table """
-        self._rows.append(row)
+        # Convert the values only once, as they are measured and printed
+        row = [str(value) for value in row]
+        if self._widths:
+            self._print_header_once()
+            self._pprint_row(row, self._widths)
+        else:
+            self._rows.append(row)
+            if self._sample and len(self._rows) >= self._sample:
+                self._flush_sample()
 
     def separator(self, position=-1):
         """ Appends a separator to the table """
         # A None row is considered a separator
-        if position > 0:
+        if self._widths:
+            self._print_header_once()
+            self._pprint_separator(self._widths)
+        elif position > 0:
             self._rows.insert(position, None)
         else:
             self._rows.append(None)
 
     def pprint(self):
         """ Pretty printstable """
+        if self._sample and not self._widths:
+            self._flush_sample()
+        if self._widths:
+            # Rows have already been printed. Just print the header if
+            # the table is empty
+            self._print_header_once()
+            return
+
         # Get the column paddings
         col_paddings = []
         for column in range(len(self._headers)):
@@ -40,21 +78,36 @@ class PTable:
             else:
                 self._pprint_separator(col_paddings)
 
+    def _print_header_once(self):
+        """ Prints the header of a streamed table if not printed yet """
+        if not self._header_printed:
+            self._header_printed = True
+            self._pprint_header(self._widths)
+
+    def _flush_sample(self):
+        """ Sets the widths from the sampled rows and prints them """
+        self._widths = [self._max_width(column)
+                for column in range(len(self._headers))]
+        self._print_header_once()
+        for row in self._rows:
+            if row:
+                self._pprint_row(row, self._widths)
+            else:
+                self._pprint_separator(self._widths)
+        self._rows = []
+
     def _max_width(self, column):
         """ Get the maximum width of the given column index """
         lengths = [len(str(self._headers[column]))]
         for row in self._rows:
             if row:     # Ignore separators
-                lengths.append(len(str(row[column])))
+                lengths.append(len(row[column]))
         return max(lengths)
 
     def _pprint_row(self, row, col_paddings):
         """ Pretty prints the given row """
-        for column in range(len(row)):
-            value = str(row[column])
-            col = value.ljust(col_paddings[column] + 1)
-            print col,
-        print
+        self._write(" ".join([str(row[column]).ljust(col_paddings[column] + 1)
+            for column in range(len(row))]))
 
     def _pprint_header(self, col_paddings):
         """ Pretty prints the table header """
@@ -63,47 +116,143 @@ class PTable:
 
     def _pprint_separator(self, col_paddings):
         """ Prints a separator line """
-        for column in range(len(self._headers)):
-            print "-" * col_paddings[column], "",
-        print
-
-
-def pprint_vms(vms, verbose=False):
-    """ Pretty prints the given virtual machine list """
-    table = PTable(["id", "name", "cpu", "ram", "hd", "state", "vnc",
-        "template", "virtual datacenter"])
-    if verbose:
-        table.headers.extend(["virtual appliance", "enterprise"])
-    for vm in vms:
-        state = vm.getState()
-        row = [vm.getId(), vm.getInternalName(), vm.getCpu(),
-                str(vm.getRam()) + " MB",
-                str(vm.getHdInBytes() / 1024 / 1024) + " MB", state]
-        if not state.existsInHypervisor():
-            row.append("-")
-        else:
-            row.append(vm.getVncAddress() + ":" + str(vm.getVncPort()))
-        row.extend([vm.getTemplate().getName(),
-            vm.getVirtualDatacenter().getName()])
+        self._write(" ".join(["-" * col_paddings[column] + " "
+            for column in range(len(self._headers))]))
+
+    def _write(self, line):
+        """ Writes a line to the output stream """
+        (self._out or sys.stdout).write(line + "\n")
+
+
+def page(items, offset=0, limit=None):
+    """ Returns an iterator over a page of the given items.
+
+    Items are consumed lazily, so the ones after the page are never
+    fetched.
+    """
+    end = offset + limit if limit is not None else None
+    return itertools.islice(items, offset, end)
+
+
+def parse_columns(spec, columns):
+    """ Parses a comma separated list of column names.
+
+    Returns None if there is no spec, so the default columns are used.
+    Raises a ValueError if a column is not in the given definitions.
+    """
+    if not spec:
+        return None
+    names = [name.strip() for name in spec.split(",") if name.strip()]
+    available = [column[0] for column in columns]
+    for name in names:
+        if name not in available:
+            raise ValueError("Unknown column %s. Available columns: %s" %
+                    (name, ",".join(available)))
+    return names
+
+
+def _pprint_columns(entities, columns, names, sample=None, widths=None,
+        links=None, output=None):
+    """ Pretty prints the given columns of each entity.
+
+    The columns are (name, header, getter) tuples, and only the getters of
+    the columns with the given names are called, so related entities are
+    fetched only if a selected column needs them. Rows are written in the
+    format of the given output, or as a table to stdout by default.
+    """
+    links = links or LinkCache()
+    selected = [column for name in names
+            for column in columns if column[0] == name]
+    if output and output.format != "table":
+        table = output.writer([name for (name, header, getter) in selected])
+    else:
+        table = PTable([header for (name, header, getter) in selected],
+                widths and [widths[name]
+                    for (name, header, getter) in selected],
+                sample, output and output.stream())
+    for entity in entities:
+        table.add([getter(entity, links)
+            for (name, header, getter) in selected])
+    table.pprint()
+
+
+def _vm_vnc(vm, links):
+    if not vm.getState().existsInHypervisor():
+        return "-"
+    return vm.getVncAddress() + ":" + str(vm.getVncPort())
+
+
+VM_COLUMNS = [
+    ("id", "id", lambda vm, links: vm.getId()),
+    ("name", "name", lambda vm, links: vm.getInternalName()),
+    ("cpu", "cpu", lambda vm, links: vm.getCpu()),
+    ("ram", "ram", lambda vm, links: str(vm.getRam()) + " MB"),
+    ("hd", "hd", lambda vm, links:
+        str(vm.getHdInBytes() / 1024 / 1024) + " MB"),
+    ("state", "state", lambda vm, links: vm.getState()),
+    ("vnc", "vnc", _vm_vnc),
+    ("template", "template", lambda vm, links:
+        links.follow(vm, "virtualmachinetemplate", vm.getTemplate)
+            .getName()),
+    ("vdc", "virtual datacenter", lambda vm, links:
+        links.follow(vm, "virtualdatacenter", vm.getVirtualDatacenter)
+            .getName()),
+    ("vapp", "virtual appliance", lambda vm, links:
+        links.follow(vm, "virtualappliance", vm.getVirtualAppliance)
+            .getName()),
+    ("enterprise", "enterprise", lambda vm, links:
+        links.follow(vm, "enterprise", vm.getEnterprise).getName()),
+]
+
+
+# The columns shown by default, and the ones added in verbose mode
+VM_DEFAULT_COLUMNS = ["id", "name", "cpu", "ram", "hd", "state", "vnc",
+    "template", "vdc"]
+VM_VERBOSE_COLUMNS = ["vapp", "enterprise"]
+
+
+def pprint_vms(vms, verbose=False, sample=None, links=None, columns=None,
+        output=None):
+    """ Pretty prints the given virtual machine list.
+
+    If a sample size is given, the virtual machines are printed as they
+    are available, using the first ones to compute the column widths.
+    The related entities are resolved through the given link cache.
+    """
+    if not columns:
+        columns = list(VM_DEFAULT_COLUMNS)
         if verbose:
-            row.extend([vm.getVirtualAppliance().getName(),
-                vm.getEnterprise().getName()])
-        table.add(row)
+            columns.extend(VM_VERBOSE_COLUMNS)
+    _pprint_columns(vms, VM_COLUMNS, columns, sample=sample, links=links,
+            output=output)
+
+
+def pprint_vm_results(results):
+    """ Pretty prints the result of an operation on several vms """
+    table = PTable(["id", "name", "state", "result"])
+    [table.add([vm.getId(), vm.getInternalName(), vm.getState(), result])
+        for (vm, result) in results]
     table.pprint()
 
 
-def pprint_templates(templates):
+TEMPLATE_COLUMNS = [
+    ("id", "id", lambda t, links: t.getId()),
+    ("name", "name", lambda t, links: t.getName()),
+    ("format", "disk type", lambda t, links: t.getDiskFormatType()),
+    ("cpu", "cpu", lambda t, links: t.getCpuRequired()),
+    ("ram", "ram", lambda t, links: str(t.getRamRequired()) + " MB"),
+    ("hd", "hd", lambda t, links:
+        str(t.getHdRequired() / 1024 / 1024) + " MB"),
+    ("size", "disk file size", lambda t, links:
+        str(t.getDiskFileSize() / 1024 / 1024) + " MB"),
+]
+
+
+def pprint_templates(templates, columns=None, output=None):
     """ Pretty prints the given template list """
-    table = PTable(["id", "name", "disk type", "cpu", "ram", "hd",
-        "disk file size"])
-    for template in templates:
-        row = [template.getId(), template.getName(),
-                template.getDiskFormatType(), template.getCpuRequired(),
-                str(template.getRamRequired()) + " MB",
-                str(template.getHdRequired() / 1024 / 1024) + " MB",
-                str(template.getDiskFileSize() / 1024 / 1024) + " MB"]
-        table.add(row)
-    table.pprint()
+    _pprint_columns(templates, TEMPLATE_COLUMNS,
+            columns or [column[0] for column in TEMPLATE_COLUMNS],
+            output=output)
 
 
 def pprint_vdcs(vdcs):
@@ -134,35 +283,62 @@ def pprint_enterprises(enterprises):
     table.pprint()
 
 
-def pprint_volumes(volumes):
-    """ Pretty prints the given volume list """
-    table = PTable(["id", "name", "size", "status", "virtual datacenter",
-        "virtual machine"])
-    for vol in volumes:
-        row = [vol.getId(), vol.getName(), str(vol.getSizeInMb()) + " MB",
-                vol.getState(), vol.getVirtualDatacenter().getName()]
-        link = vol.unwrap().searchLink("virtualmachine")
-        if link:
-            row.append(link.getTitle())
-        else:
-            row.append("-")
-        table.add(row)
-    table.pprint()
+def _volume_vm(volume, links):
+    link = volume.unwrap().searchLink("virtualmachine")
+    return link and link.getTitle() or "-"
 
 
-def pprint_machines(machines):
-    """ Pretty printd the given machine list """
-    table = PTable(["id", "name", "address", "hypervisor", "state",
-        "cpu (used/total)", "ram (used/total)"])
-    for machine in machines:
-        row = [machine.getId(), machine.getName(), machine.getIp(),
-                machine.getType().name(), machine.getState().name(),
-                str(machine.getVirtualCpusUsed()) + " / " +
-                str(machine.getVirtualCpuCores()),
-                str(machine.getVirtualRamUsedInMb()) + " / " +
-                str(machine.getVirtualRamInMb()) + " MB"]
-        table.add(row)
-    table.pprint()
+VOLUME_COLUMNS = [
+    ("id", "id", lambda vol, links: vol.getId()),
+    ("name", "name", lambda vol, links: vol.getName()),
+    ("size", "size", lambda vol, links: str(vol.getSizeInMb()) + " MB"),
+    ("state", "status", lambda vol, links: vol.getState()),
+    ("vdc", "virtual datacenter", lambda vol, links:
+        links.follow(vol, "virtualdatacenter", vol.getVirtualDatacenter)
+            .getName()),
+    ("vm", "virtual machine", _volume_vm),
+]
+
+
+def pprint_volumes(volumes, sample=None, links=None, columns=None,
+        output=None):
+    """ Pretty prints the given volume list.
+
+    If a sample size is given, the volumes are printed as they are
+    available, using the first ones to compute the column widths.
+    The related entities are resolved through the given link cache.
+    """
+    _pprint_columns(volumes, VOLUME_COLUMNS,
+            columns or [column[0] for column in VOLUME_COLUMNS],
+            sample=sample, links=links, output=output)
+
+
+MACHINE_COLUMNS = [
+    ("id", "id", lambda m, links: m.getId()),
+    ("name", "name", lambda m, links: m.getName()),
+    ("address", "address", lambda m, links: m.getIp()),
+    ("hypervisor", "hypervisor", lambda m, links: m.getType().name()),
+    ("state", "state", lambda m, links: m.getState().name()),
+    ("cpu", "cpu (used/total)", lambda m, links:
+        str(m.getVirtualCpusUsed()) + " / " + str(m.getVirtualCpuCores())),
+    ("ram", "ram (used/total)", lambda m, links:
+        str(m.getVirtualRamUsedInMb()) + " / " +
+        str(m.getVirtualRamInMb()) + " MB"),
+]
+
+# Column widths used when streaming machines
+MACHINE_WIDTHS = {"id": 6, "name": 20, "address": 15, "hypervisor": 10,
+        "state": 16, "cpu": 16, "ram": 20}
+
+
+def pprint_machines(machines, stream=False, columns=None, output=None):
+    """ Pretty printd the given machine list.
+
+    If stream is set, each machine is printed as soon as it is available.
+    """
+    _pprint_columns(machines, MACHINE_COLUMNS,
+            columns or [column[0] for column in MACHINE_COLUMNS],
+            widths=stream and MACHINE_WIDTHS or None, output=output)
 
 
 def pprint_tasks(tasks):
@@ -181,3 +357,74 @@ def pprint_tasks(tasks):
             table.add(row)
         table.separator()
     table.pprint()
+
+
+def pprint_stuck_tasks(tasks):
+    """ Pretty prints the (vm, task, jobs) tuples as they are found.
+
+    Returns 1 if any task was found, so scripts can check it.
+    """
+    date_format = "%d-%m-%Y %H:%M"
+    table = PTable(["vm", "task/job", "id", "type", "status",
+        "rollback status", "date"], [8, 8, 36, 24, 24, 24, 16])
+    found = 0
+    for vm, task, jobs in tasks:
+        found += 1
+        task_date = datetime.fromtimestamp(long(task['timestamp']))
+        table.add([vm, "task", task['taskId'], task['type'], task['state'],
+            "-", task_date.strftime(date_format)])
+        for job in jobs:
+            job_date = datetime.fromtimestamp(long(job['timestamp']))
+            table.add([vm, "job", job['id'], job['type'], job['state'],
+                job['rollbackState'], job_date.strftime(date_format)])
+        table.separator()
+    table.pprint()
+    print "%s stuck tasks found" % found
+    return 1 if found else None
+
+
+def pprint_job_stats(stats):
+    """ Pretty prints the latency statistics of each job type """
+    def seconds(value):
+        return "-" if value is None else "%s s" % value
+    table = PTable(["job type", "jobs", "failed", "p50", "p90", "p99",
+        "max", "jobs/min"])
+    for type, count, failed, p50, p90, p99, top, rate in stats:
+        table.add([type, count, "%.1f %%" % (failed * 100), seconds(p50),
+            seconds(p90), seconds(p99), seconds(top), "%.2f" % rate])
+    table.pprint()
+
+
+def pprint_inventory(status):
+    """ Pretty prints the given inventory status """
+    table = PTable(["kind", "entities", "age"])
+    for kind, entities, age in status:
+        table.add([kind, entities, age])
+    table.pprint()
+
+
+def pprint_sync_stats(stats):
+    """ Pretty prints the given sync statistics """
+    table = PTable(["checked", "probed", "fetched", "not modified",
+        "entities", "bytes", "time"])
+    table.add([stats.checked, stats.probed, stats.fetched,
+        stats.checked - stats.fetched, stats.entities, stats.bytes,
+        "%.2f s" % stats.seconds])
+    table.pprint()
+
+
+def pprint_steps(steps):
+    """ Prints the status and time of each step and returns the overall one """
+    table = PTable(["step", "status", "time"])
+    failed = 0
+    for name, status, seconds, error in steps:
+        if status != "OK":
+            failed += 1
+        if error:
+            status = "%s (%s)" % (status, error)
+        elapsed = "-" if seconds is None else "%.2f s" % seconds
+        table.add([name, status, elapsed])
+    print
+    table.pprint()
+    print "%s steps, %s failed or skipped" % (len(steps), failed)
+    return 1 if failed else None
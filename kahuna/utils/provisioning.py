@@ -0,0 +1,133 @@
+#!/usr/bin/env jython
+
+from __future__ import with_statement
+import logging
+import threading
+from kahuna.utils.parallel import WorkerPool
+from com.abiquo.server.core.cloud import VirtualMachineState
+from com.google.common.collect import Iterables
+from org.jclouds.abiquo.domain.cloud import VirtualAppliance
+from org.jclouds.abiquo.domain.cloud import VirtualMachine
+from org.jclouds.abiquo.predicates.cloud import VirtualAppliancePredicates
+from org.jclouds.abiquo.predicates.cloud \
+        import VirtualMachineTemplatePredicates
+from org.jclouds.compute.domain import NodeMetadataBuilder
+from org.jclouds.compute.options import RunScriptOptions
+from org.jclouds.scriptbuilder.domain import StatementList
+
+log = logging.getLogger('kahuna')
+
+
+class NodeProvisioner:
+    """ Provisions several nodes concurrently.
+
+    Creating virtual machines concurrently causes conflicts when the
+    platform allocates their IP addresses, so only that step is
+    serialized. The deployment, the wait for SSH access and the
+    configuration of each node run in a bounded pool of threads.
+    """
+
+    def __init__(self, context, template, cores, ram, login, group,
+            parallelism):
+        """ Initializes the provisioner.
+
+        The template is the compute template with the image and location
+        of the nodes, and login the credentials to access them.
+        """
+        self.__context = context
+        self.__template = template
+        self.__cores = cores
+        self.__ram = ram
+        self.__login = login
+        self.__group = group
+        self.__parallelism = parallelism
+        self.__ip_lock = threading.Lock()
+
+    def provision(self, count, configure):
+        """ Creates and configures the given number of nodes.
+
+        The configure function is called with the index and the metadata
+        of each node once it is deployed, and returns the list of
+        statements to run in it. Yields an (index, node, result, error)
+        tuple per node as they finish, where result is the exit status of
+        the configuration script. Indexes continue after the nodes already
+        in the group.
+        """
+        vapp, template, first = self._prepare()
+        pool = WorkerPool(self.__parallelism)
+        try:
+            for index in xrange(first, first + count):
+                pool.submit(index, self._provision, vapp, template, index,
+                        configure)
+            for index, result, error in pool.results():
+                node, status = result or (None, None)
+                yield (index, node, status, error)
+        finally:
+            pool.shutdown()
+
+    def _prepare(self):
+        """ Finds the template and the virtual appliance for the nodes.
+
+        Also returns the index of the first node, after the ones already
+        in the virtual appliance, so node names are not repeated.
+        """
+        cloud = self.__context.getCloudService()
+        vdc = cloud.getVirtualDatacenter(
+                int(self.__template.getLocation().getId()))
+        template = vdc.findAvailableTemplate(VirtualMachineTemplatePredicates
+                .id(int(self.__template.getImage().getId())))
+        vapp = vdc.findVirtualAppliance(
+                VirtualAppliancePredicates.name(self.__group))
+        if not vapp:
+            log.debug("Virtual appliance %s not found. Creating it..." %
+                    self.__group)
+            vapp = VirtualAppliance.builder(self.__context.getApiContext(),
+                    vdc).name(self.__group).build()
+            vapp.save()
+            return (vapp, template, 0)
+        prefix = "%s-" % self.__group
+        indexes = [int(vm.getNameLabel()[len(prefix):])
+                for vm in vapp.listVirtualMachines()
+                if vm.getNameLabel() and vm.getNameLabel().startswith(prefix)
+                and vm.getNameLabel()[len(prefix):].isdigit()]
+        return (vapp, template, indexes and max(indexes) + 1 or 0)
+
+    def _provision(self, vapp, template, index, configure):
+        """ Provisions and configures a single node """
+        name = "%s-%s" % (self.__group, index)
+        with self.__ip_lock:
+            log.info("[%s] Creating virtual machine..." % name)
+            vm = VirtualMachine.builder(self.__context.getApiContext(),
+                    vapp, template) \
+                    .nameLabel(name) \
+                    .cpu(self.__cores) \
+                    .ram(self.__ram) \
+                    .build()
+            vm.save()
+
+        log.info("[%s] Deploying virtual machine..." % name)
+        monitor = self.__context.getMonitoringService() \
+                .getVirtualMachineMonitor()
+        vm.deploy()
+        monitor.awaitCompletionDeploy(vm)
+        vm = vapp.getVirtualMachine(vm.getId())
+        if vm.getState() != VirtualMachineState.ON:
+            raise Exception("Deployment failed with state %s" %
+                    vm.getState().name())
+
+        compute = self.__context.getComputeService()
+        node = NodeMetadataBuilder.fromNodeMetadata(
+                compute.getNodeMetadata(str(vm.getId()))) \
+                .credentials(self.__login) \
+                .build()
+        log.info("[%s] Deployed at %s. Configuring it..." % (name,
+            Iterables.getOnlyElement(node.getPublicAddresses())))
+
+        script = configure(index, node)
+        options = RunScriptOptions.Builder \
+                .overrideLoginCredentials(self.__login)
+        response = compute.runScriptOnNode(node.getId(),
+                StatementList(script), options)
+        log.info("[%s] Configured with exit status %s" % (name,
+            response.getExitStatus()))
+        return (node, response.getExitStatus())